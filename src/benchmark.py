@@ -0,0 +1,234 @@
+"""Benchmarks the feature extraction, matching, stabilization and background removal stages on the bundled samples."""
+import argparse
+import contextlib
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy
+
+import main
+from matching.classes.catalog_index import get_norm
+from matching.classes.catalog_matcher import CatalogMatcher
+from matching.classes.feature_extractor import FeatureExtractor, create_detector, describe_image
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples')
+
+parser = argparse.ArgumentParser(description='Times the processing stages on the bundled samples, writes latency '
+                                             'percentiles and throughput as JSON and compares them to a baseline.')
+parser.add_argument('--samples', help='Path to the samples folder (default: samples)', default=SAMPLES)
+parser.add_argument('-o', '--output', help='Write the results to this JSON file (default: benchmark.json)',
+                    default='benchmark.json')
+parser.add_argument('-b', '--baseline',
+                    help='Compare the results to this file written by a previous run (default: none)', default=None)
+parser.add_argument('--tolerance',
+                    help='Report a regression when the median latency of a stage exceeds the baseline by more than '
+                         'this proportion (default: 0.2)', default=0.2, type=float)
+parser.add_argument('--stages', help='Stages to run (default: all)', nargs='+',
+                    choices=['extract', 'database', 'match', 'stabilize', 'background'],
+                    default=['extract', 'database', 'match', 'stabilize', 'background'])
+parser.add_argument('--detectors', help='Detectors to benchmark (default: orb akaze)', nargs='+',
+                    choices=['orb', 'akaze', 'surf'], default=['orb', 'akaze'])
+parser.add_argument('--matchers', help='Matchers to benchmark (default: brute-force flann)', nargs='+',
+                    choices=['brute-force', 'flann'], default=['brute-force', 'flann'])
+parser.add_argument('--queries', help='Number of catalog images used as match queries (default: 5)', default=5,
+                    type=int)
+parser.add_argument('--clips', help='Number of clips of samples/lateral and samples/slowing each (default: all)',
+                    default=None, type=int)
+parser.add_argument('--repeat', help='Number of runs of the database write and read stages (default: 5)', default=5,
+                    type=int)
+parser.add_argument('--threads', help='Number of threads used by OpenCV (default: OpenCV\'s own choice)', default=None,
+                    type=int)
+
+
+class StageTimings:
+    """Durations of the items (images, queries, frames...) processed by every stage."""
+
+    def __init__(self):
+        self.durations = {}
+        self.units = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage, unit):
+        start = time.perf_counter()
+        yield
+        self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+        self.units[stage] = unit
+
+    def summary(self):
+        stages = {}
+        for stage, durations in self.durations.items():
+            milliseconds = numpy.array(durations) * 1000.
+            stages[stage] = dict(unit=self.units[stage], count=len(durations),
+                                 throughput=len(durations) / float(sum(durations)) if sum(durations) else None,
+                                 mean_ms=float(milliseconds.mean()), p50_ms=float(numpy.percentile(milliseconds, 50)),
+                                 p90_ms=float(numpy.percentile(milliseconds, 90)),
+                                 p99_ms=float(numpy.percentile(milliseconds, 99)), max_ms=float(milliseconds.max()))
+        return stages
+
+
+def detector_options():
+    return dict(orb_n_features=2000, akaze_n_channels=3, surf_threshold=1000)
+
+
+def read_clips(samples, clips):
+    for folder in ['lateral', 'slowing']:
+        for path in sorted(glob.glob(os.path.join(samples, folder, '*.avi')))[:clips]:
+            cap = cv2.VideoCapture(path)
+            frames = []
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frames.append(frame)
+            cap.release()
+            yield folder, frames
+
+
+def benchmark_extraction(timings, image_paths, detector_type):
+    detector = create_detector(detector_type, detector_options())
+    for image_path in image_paths:
+        with timings.measure('extract.%s' % detector_type, 'image'):
+            describe_image(detector, image_path)
+
+
+def benchmark_database(timings, image_descriptions, repeat):
+    feature_extractor = FeatureExtractor(False)
+    database_path = os.path.join(tempfile.mkdtemp(), 'features.db')
+    try:
+        for _ in range(repeat):
+            with timings.measure('database.serialize', 'database'):
+                feature_extractor.serialize(image_descriptions, database_path)
+            with timings.measure('database.deserialize', 'database'):
+                feature_extractor.deserialize(database_path)
+    finally:
+        os.remove(database_path)
+        os.rmdir(os.path.dirname(database_path))
+
+
+def benchmark_matching(timings, image_descriptions, detector_type, matcher_types, queries):
+    # Queries are spread over the catalog.
+    step = max(1, len(image_descriptions) // max(queries, 1))
+    query_descriptions = image_descriptions[::step][:queries]
+
+    for matcher_type in matcher_types:
+        catalog_matcher = CatalogMatcher(image_descriptions, get_norm(detector_type), matcher_type)
+        for query_description in query_descriptions:
+            with timings.measure('match.%s.%s' % (detector_type, matcher_type), 'query'):
+                catalog_matcher.match(query_description.descriptors, query_description.histogram, 0.75)
+
+
+def benchmark_stabilization(timings, folder, frames):
+    stabilizer = main.Stabilizer(main.FrameRingBuffer(len(frames), frames[0].shape))
+    for frame in frames:
+        with timings.measure('stabilize.%s' % folder, 'frame'):
+            stabilizer.add(frame)
+
+
+def benchmark_background_removal(timings, folder, frames):
+    background_subtractor = cv2.createBackgroundSubtractorKNN()
+    surface = main.args['width'] * main.args['height']
+    for i, frame in enumerate(frames):
+        with timings.measure('background.%s' % folder, 'frame'):
+            mask = background_subtractor.apply(frame)
+            main.process_mask(frame, mask, i, surface, main.args)
+
+
+def compare(stages, baseline, tolerance):
+    """Prints every stage next to its baseline, returns the names of the stages that got slower."""
+    regressions = []
+    print("%-28s %-8s %10s %10s %10s %10s" % ('stage', 'unit', 'p50 (ms)', 'p90 (ms)', 'per second', 'vs base'))
+    for stage, result in sorted(stages.items()):
+        comparison = ''
+        base = baseline.get(stage) if baseline else None
+        if base and base['p50_ms']:
+            change = result['p50_ms'] / base['p50_ms'] - 1.
+            comparison = '%+.1f%%' % (100. * change)
+            if change > tolerance:
+                regressions.append(stage)
+        print("%s%-28s %-8s %10.2f %10.2f %10.1f %10s\033[0m" % ('\033[91m' if stage in regressions else '', stage,
+                                                                result['unit'], result['p50_ms'], result['p90_ms'],
+                                                                result['throughput'] or 0, comparison))
+    return regressions
+
+
+def run():
+    options = vars(parser.parse_args())
+
+    if options['threads'] is not None:
+        cv2.setNumThreads(options['threads'])
+    # Background subtraction and stabilization draw random numbers.
+    cv2.setRNGSeed(0)
+
+    timings = StageTimings()
+    image_paths = FeatureExtractor.list_images(os.path.join(options['samples'], 'products-front-back'))
+
+    start = time.time()
+
+    for detector_type in options['detectors']:
+        try:
+            create_detector(detector_type, detector_options())
+        except (AttributeError, cv2.error):
+            print("\033[93mWarning: detector %s is not available in this OpenCV build, skipping it.\033[0m" %
+                  detector_type)
+            continue
+
+        if 'extract' in options['stages']:
+            print("\033[94mExtracting %s features.\033[0m" % detector_type)
+            benchmark_extraction(timings, image_paths, detector_type)
+
+        if 'database' in options['stages'] or 'match' in options['stages']:
+            image_descriptions = FeatureExtractor(False).extract(
+                os.path.join(options['samples'], 'products-front-back'), detector_type, detector_options())
+            if 'database' in options['stages'] and detector_type == options['detectors'][0]:
+                print("\033[94mWriting and reading the %s feature database.\033[0m" % detector_type)
+                benchmark_database(timings, image_descriptions, options['repeat'])
+            if 'match' in options['stages']:
+                print("\033[94mMatching %s features.\033[0m" % detector_type)
+                benchmark_matching(timings, image_descriptions, detector_type, options['matchers'],
+                                   options['queries'])
+
+    if 'stabilize' in options['stages'] or 'background' in options['stages']:
+        print("\033[94mStabilizing and removing background.\033[0m")
+        # Silence the progress messages of main.py.
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for folder, frames in read_clips(options['samples'], options['clips']):
+                if not frames:
+                    continue
+                if 'stabilize' in options['stages']:
+                    benchmark_stabilization(timings, folder, frames)
+                if 'background' in options['stages']:
+                    benchmark_background_removal(timings, folder, frames)
+
+    results = dict(environment=dict(python=platform.python_version(), opencv=cv2.__version__,
+                                    numpy=numpy.__version__, platform=platform.platform(),
+                                    cpus=os.cpu_count(), opencv_threads=cv2.getNumThreads()),
+                   options=dict((key, value) for key, value in options.items() if key not in ('output', 'baseline')),
+                   seconds=time.time() - start, stages=timings.summary())
+
+    with open(options['output'], 'w') as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+
+    baseline = None
+    if options['baseline'] is not None:
+        with open(options['baseline'], 'r') as baseline_file:
+            baseline = json.load(baseline_file)['stages']
+
+    regressions = compare(results['stages'], baseline, options['tolerance'])
+
+    print("\033[94mBenchmark has been run in %s seconds, results written to %s.\033[0m" % (results['seconds'],
+                                                                                            options['output']))
+    if regressions:
+        print("\033[91m%d stages are slower than the baseline: %s.\033[0m" % (len(regressions), ', '.join(regressions)))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
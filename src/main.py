@@ -1,11 +1,25 @@
 """Script to detect objects that are being shaken in front of the camera."""
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import glob
+import heapq
+import json
+import logging
 import math
+import multiprocessing
+import os
 import sys
+import time
 
 import cv2
 import numpy
 
+from matching.classes.instrumentation import instrumentation
+from matching.classes.segmentation import clean_mask, remove_small_components
+
 parser = argparse.ArgumentParser(description='Detect/compare objects being shaken in front of the camera.')
 parser.add_argument('--source', help='Video to use (default: built-in cam)', default=0)
 parser.add_argument('--dump-raw', help='Write raw captured video to this file (default: none)', default=None)
@@ -46,51 +60,160 @@ parser.add_argument('--remove-shadows', help='Pixels that look like shadows shou
 parser.add_argument('--no-remove-shadows', help='Pixels that look like shadows should be considered part of the extracted object (default).', dest='remove_shadows', action='store_false')
 parser.set_defaults(remove_shadows=False)
 
+parser.add_argument('--jobs', help='Number of threads post-processing the masks of the frames (default: number of CPUs).', default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--log-level', help='Level of the progress messages, "debug" shows every frame and transform (default: info).', choices=['debug', 'info', 'warning'], default='info')
+parser.add_argument('--verbose', help='Time every processing stage and print a summary of them at the end.', action='store_true')
+parser.add_argument('--profile', help='Write the stage timings and counters as JSON to this file (default: none).', default=None)
+parser.add_argument('--trace', help='Write every timed stage as a Chrome trace (chrome://tracing) to this file (default: none).', default=None)
+
 parser.add_argument('--use-contour', dest='use_contour', action='store_true')
 parser.add_argument('--no-use-contour', dest='use_contour', action='store_false')
 parser.set_defaults(use_contour=False)
 
-args = vars(parser.parse_args())
-if args['buffer_init'] <= 0:
-    args['buffer_init'] = .01
-elif args['buffer_init'] >= 1:
-    args['buffer_init'] = .99
-print ("Args: %s" % args)
+parser.add_argument('--batch', help='Process these clips instead of --source, in parallel and without any window: video files, folders (of .avi files) or glob patterns (default: none).', nargs='+', default=None)
+parser.add_argument('--output', help='Write the objects and masks of every clip of --batch to a folder of its own in this destination (default: objects).', default='objects')
+parser.add_argument('--workers', help='Number of clips of --batch processed in parallel (default: number of CPUs).', default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--summary', help='Write the summary of --batch as JSON to this file (default: summary.json in --output).', default=None)
 
 
-def main():
-    cap = cv2.VideoCapture(args['source'])
+
+def parse_args(argv=None):
+    args = vars(parser.parse_args(argv))
+    if args['buffer_init'] <= 0:
+        args['buffer_init'] = .01
+    elif args['buffer_init'] >= 1:
+        args['buffer_init'] = .99
+    return args
+
+
+# When imported (e.g. by benchmark.py), the default options are used. Worker processes started by `--batch` import
+# the script as `__mp_main__`.
+args = parse_args(None if __name__ in ('__main__', '__mp_main__') else [])
+if __name__ == '__main__':
+    print ("Args: %s" % args)
+
+LOG_FORMAT = '%(message)s'
+logging.basicConfig(format=LOG_FORMAT, level=getattr(logging, args['log_level'].upper()))
+log = logging.getLogger('main')
+
+# Set up at import time, so that the worker processes of `--batch` time their stages too.
+if args['verbose'] or args['profile'] or args['trace']:
+    instrumentation.enable(tracing=bool(args['trace']))
+
+
+class FrameRingBuffer:
+    """Holds the last `capacity` captured frames in a single preallocated (capacity + 1, height, width, 3) array.
+
+    Frames are captured straight into `next_slot()` (e.g. with `cap.read(image=...)`) then kept with `commit()`, which
+    drops the oldest frame once the buffer is full. The extra slot is the one being written to, so that a failed
+    capture never overwrites a buffered frame.
+    """
+
+    def __init__(self, capacity, shape):
+        self.capacity = capacity
+        self.slots = numpy.zeros((capacity + 1,) + tuple(shape), numpy.uint8)
+        # Index of the oldest frame, and number of frames held.
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('frame index out of range')
+        return self.slots[(self.start + index) % len(self.slots)]
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def next_slot(self):
+        return self.slots[(self.start + self.count) % len(self.slots)]
+
+    def commit(self, frame):
+        """Keeps `frame`, the content of `next_slot()` or, if the capture did not write into it, a copy."""
+        slot = self.next_slot()
+        if frame is not slot and not numpy.shares_memory(frame, slot):
+            if frame.shape != slot.shape:
+                # The source does not have the expected size: start again with the size it does have.
+                self.slots = numpy.zeros((len(self.slots),) + frame.shape, numpy.uint8)
+                self.clear()
+                slot = self.next_slot()
+            slot[...] = frame
+
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % len(self.slots)
+
+        return slot
+
+    def views(self):
+        # The frames, oldest first, as views into the buffer (nothing is copied).
+        return [self[index] for index in range(self.count)]
+
+
+def isolate_objects(options):
+    """Captures frames from `options['source']` and isolates the object being shaken in front of the camera.
+
+    `options` are the parsed arguments of the script, or the ones of a clip of `--batch`.
+
+    Returns a summary of the objects found (or None if the source cannot be opened).
+    """
+    cap = cv2.VideoCapture(options['source'])
     if cap is None or not cap.isOpened():
         print('Error: unable to open video source')
-        return -1
+        return None
 
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, args['width'])
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, args['height'])
+    # Background subtraction and stabilization draw random numbers: start every source from the state of a new
+    # process (seed 0 is the default one), whatever was processed before.
+    cv2.setRNGSeed(0)
+
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, options['width'])
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, options['height'])
 
     backgroundSubstractor = cv2.createBackgroundSubtractorKNN()
 
     idle = True
-    force_start = args['autostart']
+    force_start = options['autostart']
+
+    # A buffer holding the frames. It will hold up to options['buffer'] frames.
+    frames = FrameRingBuffer(max(options['buffer'], 1), (options['height'], options['width'], 3))
+    # A scratch frame, used while idle.
+    idle_frame = None
 
-    # A buffer holding the frames. It will hold up to args['buffer'] framesselfself.
-    frames = None
+    # Frames are stabilized as soon as they are captured.
+    stabilizer = None
+    if options['stabilize']:
+        stabilized_writer = None
+        if options['dump_stabilized']:
+            stabilized_writer = cv2.VideoWriter(options['dump_stabilized'], cv2.VideoWriter_fourcc(*"DIVX"), 16, (options['width'], options['height']));
+        stabilizer = Stabilizer(FrameRingBuffer(max(options['buffer'], 1), (options['height'], options['width'], 3)), writer=stabilized_writer)
 
     # The size of the largest suffix of `frames` composed solely of stable frames.
     consecutive_stable_frames = 0
-    surface = args['width'] * args['height']
+    surface = options['width'] * options['height']
 
     raw_writer = None
-    if args['dump_raw']:
-        raw_writer = cv2.VideoWriter(args['dump_raw'], cv2.VideoWriter_fourcc(*"DIVX"), 16, (args['width'], args['height']));
+    if options['dump_raw']:
+        raw_writer = cv2.VideoWriter(options['dump_raw'], cv2.VideoWriter_fourcc(*"DIVX"), 16, (options['width'], options['height']));
 
     while(True):
         # Capture frame-by-frame.
         if not cap:
             break
-        ret, current = cap.read()
+        with instrumentation.stage('capture'):
+            if idle and not force_start:
+                ret, idle_frame = cap.read(image=idle_frame)
+                current = idle_frame
+            else:
+                ret, current = cap.read(image=frames.next_slot())
 
         key = None
-        if args['show']:
+        if options['show']:
             key = cv2.waitKey(1) & 0xFF
             # <q> or <Esc>: quit
             if key == 27 or key == ord('q'):
@@ -102,7 +225,9 @@ def main():
         if force_start:
             force_start = False
             idle = False
-            frames = []
+            frames.clear()
+            if stabilizer:
+                stabilizer.reset()
             consecutive_stable_frames = 0
 
         if not ret:
@@ -110,7 +235,7 @@ def main():
             break
 
         # Display the current frame
-        if args['show']:
+        if options['show']:
             cv2.imshow('frame', current)
             cv2.moveWindow('frame', 0, 0)
 
@@ -119,34 +244,37 @@ def main():
 
         if idle:
             # We are not capturing at the moment.
-            print("Idle, proceeding.")
+            log.debug("Idle, proceeding.")
             continue
 
         if not cap.isOpened():
             print("Video source closed.")
             break
 
-        if len(frames) > 0 and args['buffer_stable_frames'] > 0:
+        if len(frames) > 0 and options['buffer_stable_frames'] > 0:
             diff = compute_diff(frames[-1], current)
-            print("Diff: %d <? %d" % (diff, surface * args['buffer_stability']))
-            if diff <= surface * args['buffer_stability']:
+            log.debug("Diff: %d <? %d", diff, surface * options['buffer_stability'])
+            if diff <= surface * options['buffer_stability']:
                 consecutive_stable_frames += 1
             else:
                 consecutive_stable_frames = 0
 
         # We are not done buffering.
-        print("Got %d/%d frames, %d/%d stable frames." % (len(frames), args['buffer'], consecutive_stable_frames, args['buffer_stable_frames']))
-        frames.append(current)
-
-        if len(frames) >= args['buffer']:
-            if consecutive_stable_frames >= args['buffer_stable_frames']:
-                # We have enough frames and enough stable frames.
-                print("We have enough stable frames.")
-                break
-            else:
-                # Make way for more frames.
-                frames.pop(0)
-        print("Continuing capture.")
+        log.debug("Got %d/%d frames, %d/%d stable frames.", len(frames), options['buffer'], consecutive_stable_frames, options['buffer_stable_frames'])
+        # Once the buffer is full, this makes way for the new frame by dropping the oldest one.
+        current = frames.commit(current)
+        instrumentation.count('frames captured')
+        if stabilizer:
+            with instrumentation.stage('stabilize'):
+                stabilized = stabilizer.add(current)
+            if stabilized is None:
+                instrumentation.count('frames skipped by stabilization')
+
+        if len(frames) >= options['buffer'] and consecutive_stable_frames >= options['buffer_stable_frames']:
+            # We have enough frames and enough stable frames.
+            print("We have enough stable frames.")
+            break
+        log.debug("Continuing capture.")
 
     print("Capture complete.")
 
@@ -156,253 +284,352 @@ def main():
     cap.release()
     cap = None
 
-
-    if args['stabilize']:
-        print("Stabilizing.")
-        frames = stabilize(frames)
+    # Views into the buffer, oldest first.
+    if stabilizer:
+        frames = crop(stabilizer.output.views())
+    else:
+        frames = frames.views()
 
     # Extract foreground
+    # The best `--keep` frames so far, as a min-heap of (score, -frame index): the lowest score, then the latest
+    # frame, is the first to go. Only the masks of these frames are kept.
     candidates = []
+    candidate_masks = {}
 
     print("Removing background.")
-    for i, frame in enumerate(frames):
-        height, width = frame.shape[:2]
-
-        mask = backgroundSubstractor.apply(frame) # FIXME: Is this the right subtraction?
-        original_mask = mask.copy()
-
-        if args['remove_shadows']:
-            mask = cv2.bitwise_and(mask, 255)
-
-        # Smoothen a bit the mask to get back some of the missing pixels
-        if args['blur'] > 0:
-            mask = cv2.blur(mask, (args['blur'], args['blur']))
-
-        ret, mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
-
-        corners = [[0, 0], [height - 1, 0], [0, width - 1], [height - 1, width - 1]]
-
-        score = cv2.countNonZero(mask)
-        print("Starting with a score of %d." % score)
-        if args['fill_holes'] and score != surface:
-            # Attempt to fill any holes.
-            # At this stage, often, we have a mask surrounded by black and containing holes.
-            # (this is not always the case -  sometimes, the mask is a cloud of points).
-            positive = mask.copy()
-            fill_mask = numpy.zeros((height + 2, width + 2), numpy.uint8)
-            found = False
-            for y,x in corners:
-                if positive[y, x] == 0:
-                    cv2.floodFill(positive, fill_mask, (x, y), 255)
-                    found = True
-                    break
-
-            if found:
-                filled = cv2.bitwise_or(mask, cv2.bitwise_not(positive))
-
-                # Check if we haven't filled too many things, in which case
-                # our fill operation actually decreased the quality of the
-                # image.
-                filled_score = cv2.countNonZero(filled)
-                if filled_score < surface * .9:
-                    has_empty_corners = False
-                    for y, x in corners:
-                        if filled[y, x] == 0:
-                            has_empty_corners = True
-                            break
-                    if has_empty_corners:
-                        # Apparently, we have managed to remove holes, without filling
-                        # the entire frame.
-                        score = filled_score
-                        mask = filled
-                        print("Improved to a score of %d" % score)
-
-        bw_mask = mask
-
-        if args['show']:
-            cv2.imshow('mask', mask)
-            cv2.moveWindow('mask', args['width'] + 32, args['height'] + 32)
-
-        if args['use_contour']:
-            image, contours, hierarchy = cv2.findContours(bw_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-
-            # FIXME: We could remove small contours (here or later)
-            bw_mask = numpy.zeros((height, width), numpy.uint8)
-            for cnt in contours:
-                if cv2.contourArea(cnt) > args['min_size'] or 0:
-                    hull = cv2.convexHull(cnt)
-                    cv2.fillPoly(bw_mask, [hull], 255, 8)
-
-            if args['contours_prefix']:
-                dest = "%s_%d.png" % (args['contours_prefix'], i)
-                print("Writing contours to %s." % dest)
-                cv2.imwrite(dest, bw_mask)
-
-            print("contours: %d, score: %d" % (len(contours), score))
-
-        score = cv2.countNonZero(bw_mask)
-        mask = cv2.cvtColor(bw_mask, cv2.COLOR_GRAY2RGB)
-        extracted = cv2.bitwise_and(mask, frame)
-        if args['show']:
-            cv2.imshow('extracted', extracted)
-            cv2.moveWindow('extracted', 0, args['height'] + 32)
-
-        if score != surface:
-            # We have captured the entire image. Definitely not a good thing to do.
-            if i > len(frames) * args['buffer_init'] or i + 1 == len(frames):
-                # We are done buffering
-                candidates.append((score, mask, bw_mask, original_mask, extracted, i, 0))
-
-        latest_score = score
-
-    candidates.sort(key=lambda tuple: tuple[0], reverse=True)
-    candidates = candidates[:args['keep']]
-
-    for candidate_index, candidate in enumerate(candidates):
-        best_score, best_mask, best_bw_mask, best_original_mask, best_extracted, best_index, best_perimeter = candidate
+    # The background subtractor must see the frames in order, the masks it computes are post-processed in parallel
+    # while it proceeds with the next frames.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(options['jobs'], 1)) as executor:
+        pending = collections.deque()
+        for i, frame in enumerate(frames):
+            with instrumentation.stage('background.subtract'):
+                mask = backgroundSubstractor.apply(frame) # FIXME: Is this the right subtraction?
+            pending.append(executor.submit(process_mask, frame, mask, i, surface, options))
+
+            # Consume the results in order, without holding the masks of every frame.
+            while pending and (pending[0].done() or len(pending) > 2 * options['jobs'] or i + 1 == len(frames)):
+                score, bw_mask, original_mask, index = pending.popleft().result()
+
+                if options['show']:
+                    cv2.imshow('mask', bw_mask)
+                    cv2.moveWindow('mask', options['width'] + 32, options['height'] + 32)
+                    cv2.imshow('extracted', extract(frames[index], bw_mask)[1])
+                    cv2.moveWindow('extracted', 0, options['height'] + 32)
+
+                if score != surface:
+                    # We have captured the entire image. Definitely not a good thing to do.
+                    if (index > len(frames) * options['buffer_init'] or index + 1 == len(frames)) and options['keep'] > 0:
+                        # We are done buffering
+                        candidate_masks[index] = (bw_mask, original_mask)
+                        instrumentation.count('candidate masks')
+                        if len(candidates) < options['keep']:
+                            heapq.heappush(candidates, (score, -index))
+                        else:
+                            dropped_score, dropped_index = heapq.heappushpop(candidates, (score, -index))
+                            del candidate_masks[-dropped_index]
+
+    # Best score first, earliest frame first among equal scores.
+    candidates = [(score, -negative_index) for score, negative_index in sorted(candidates, reverse=True)]
+    objects = []
+
+    for candidate_index, (best_score, best_index) in enumerate(candidates):
+        best_perimeter = 0
+        best_bw_mask, best_original_mask = candidate_masks.pop(best_index)
+        with instrumentation.stage('output.extract'):
+            best_mask, best_extracted = extract(frames[best_index], best_bw_mask)
 
         print ("Best score %d/%s" % (best_score, best_perimeter))
 
 # Get rid of small components
-        if args['min_size'] > 0:
-            number, components = cv2.connectedComponents(best_bw_mask)
-            flattened = components.flatten()
-            stats = numpy.bincount(flattened)
-            # FIXME: Optimize this
-            removing = 0
-            for i, stat in enumerate(stats):
-                if stat == 0:
-                    continue
-                if stat < args['min_size']:
-                    kill_list = components == i
-                    best_mask[kill_list] = 0
-                    best_extracted[kill_list] = 0
-                    removing += 1
+        if options['min_size'] > 0:
+            with instrumentation.stage('output.components'):
+                remove_small_components(best_bw_mask, options['min_size'], [best_mask, best_extracted])
 
 # Add transparency
 #        cv2.mixChannels([best_extracted, best_mask], [0, 0, 1, 1, 2, 2, ])
         split_1, split_2, split_3 = cv2.split(best_extracted)
         transparency = cv2.merge([split_1, split_2, split_3, best_bw_mask])
-        if args['objects_prefix']:
-            dest = "%s_%d.png" % (args['objects_prefix'], candidate_index)
+        summary = dict(frame=int(best_index), score=int(best_score), object=None, mask=None)
+        if options['objects_prefix']:
+            dest = "%s_%d.png" % (options['objects_prefix'], candidate_index)
             print("Writing object to %s." % dest)
             cv2.imwrite(dest, transparency)
-        if args['masks_prefix']:
-            dest = "%s_%d.png" % (args['masks_prefix'], candidate_index)
+            summary['object'] = dest
+        if options['masks_prefix']:
+            dest = "%s_%d.png" % (options['masks_prefix'], candidate_index)
             print("Writing mask to %s." % dest)
             cv2.imwrite(dest, best_original_mask)
+            summary['mask'] = dest
+        objects.append(summary)
 
-    cv2.destroyAllWindows()
+    if options['show']:
+        cv2.destroyAllWindows()
 
+    return dict(frames=len(frames), objects=objects)
 
-def stabilize(frames):
-    # Accumulated frame transforms.
-    acc_dx = 0
-    acc_dy = 0
-    acc_da = 0
 
-    acc_transform = numpy.zeros((3, 3), numpy.float32)
-    acc_transform[0, 0] = 1
-    acc_transform[1, 1] = 1
-    acc_transform[2, 2] = 1
+def list_sources(patterns):
+    """Video files designated by `patterns`: files, folders (their .avi files) or glob patterns."""
+    sources = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            sources.extend(sorted(glob.glob(os.path.join(pattern, '*.avi'))))
+        else:
+            sources.extend(sorted(glob.glob(pattern)) or [pattern])
+    return sources
+
+
+@contextlib.contextmanager
+def redirect_logging(stream):
+    """Sends the records of all loggers to `stream` instead of the handlers of the root logger, while active."""
+    root = logging.getLogger()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handlers = root.handlers[:]
+    root.handlers = [handler]
+    try:
+        yield
+    finally:
+        root.handlers = handlers
+        handler.flush()
+
+
+def process_clip(source, options):
+    """Isolates the objects of one clip of a batch, without any window, writing them to their own folder.
+
+    `options` are the options of the batch, the ones of the clip are derived from them.
+    """
+    start = time.time()
+    clip_directory = os.path.join(options['output'], os.path.basename(os.path.dirname(os.path.abspath(source))),
+                                  os.path.splitext(os.path.basename(source))[0])
+    if not os.path.isdir(clip_directory):
+        os.makedirs(clip_directory)
+
+    clip_options = dict(options, source=source, show=False, autostart=True,
+                        objects_prefix=os.path.join(clip_directory, 'object'),
+                        masks_prefix=os.path.join(clip_directory, 'mask'),
+                        contours_prefix=(os.path.join(clip_directory, 'contours') if options['contours_prefix']
+                                         else None),
+                        dump_raw=None, dump_stabilized=None)
+
+    summary = dict(source=source, output=clip_directory)
+    try:
+        # The progress messages and the log records of a clip go to its own log.
+        with open(os.path.join(clip_directory, 'log.txt'), 'w') as log_file, contextlib.redirect_stdout(log_file), \
+                redirect_logging(log_file):
+            result = isolate_objects(clip_options)
+        if result is None:
+            summary.update(status='error', error='unable to open video source')
+        else:
+            summary.update(status='ok', **result)
+    except Exception as exception:
+        summary.update(status='error', error=str(exception))
+    summary['seconds'] = time.time() - start
+    # The stages timed in a worker process are sent back to the main one.
+    summary['instrumentation'] = instrumentation.collect()
+
+    return summary
 
-    # Highest translations (left/right, top/bottom), used to compute a mask
-    min_acc_dx = 0
-    max_acc_dx = 0
-    min_acc_dy = 0
-    max_acc_dy = 0
 
-    stabilized = []
+def run_batch():
+    sources = list_sources(args['batch'])
+    workers = max(1, min(args['workers'], len(sources)))
+    # Every clip gets a single worker process, do not also spread each clip over threads. The options are sent to
+    # the workers along with every clip, as spawned worker processes do not share the globals of this one.
+    process = functools.partial(process_clip, options=dict(args, jobs=1))
 
-    prev = frames[0]
-    prev_gray = cv2.cvtColor(prev, cv2.COLOR_RGB2GRAY)
+    start = time.time()
+    print("Processing %d clips with %d workers." % (len(sources), workers))
 
-    stabilized_writer = None
+    clips = []
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for summary in (pool.imap(process, sources) if pool else map(process, sources)):
+            instrumentation.merge(summary.pop('instrumentation'))
+            print("%s: %s, %d objects in %.2f seconds." % (summary['source'], summary['status'],
+                                                           len(summary.get('objects', [])), summary['seconds']))
+            clips.append(summary)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    seconds = time.time() - start
+    summary_path = args['summary'] or os.path.join(args['output'], 'summary.json')
+    with open(summary_path, 'w') as summary_file:
+        json.dump(dict(workers=workers, seconds=seconds, clips=clips), summary_file, indent=2)
+
+    print("Processed %d clips in %.2f seconds, summary written to %s." % (len(clips), seconds, summary_path))
+
+    return 0 if all(clip['status'] == 'ok' for clip in clips) else -1
+
+
+def main():
+    if args['batch']:
+        status = run_batch()
+    else:
+        status = 0 if isolate_objects(args) is not None else -1
 
+    instrumentation.report(args['verbose'], args['profile'], args['trace'])
+
+    return status
+
+
+def process_mask(frame, mask, i, surface, options):
+    """Cleans up the background subtraction mask of frame `i`, with the cleanup `options` of the script.
+
+    Returns the score of the mask, the mask, the mask as it was before post-processing and `i`.
+    """
+    with instrumentation.stage('background.cleanup'):
+        original_mask = mask.copy()
+        contours_path = "%s_%d.png" % (options['contours_prefix'], i) if options['contours_prefix'] else None
+        score, bw_mask = clean_mask(mask, options['blur'], options['min_size'], options['remove_shadows'],
+                                    options['fill_holes'], options['use_contour'], surface, contours_path)
+
+    return score, bw_mask, original_mask, i
+
+
+def extract(frame, bw_mask):
+    """Returns the mask as RGB and the object of `frame` it covers."""
+    mask = cv2.cvtColor(bw_mask, cv2.COLOR_GRAY2RGB)
+    return mask, cv2.bitwise_and(mask, frame)
+
+
+def estimate_rigid_transform(prev_corners, cur_corners):
+    """Combination of translation, rotation and uniform scaling between two sets of points, or None."""
+    if hasattr(cv2, 'estimateRigidTransform'):
+        return cv2.estimateRigidTransform(prev_corners, cur_corners, False)
+    # OpenCV 4 replaced `estimateRigidTransform`.
+    transform, inliers = cv2.estimateAffinePartial2D(prev_corners, cur_corners)
+    return transform
+
+
+class Stabilizer:
+    """Stabilizes frames one at a time, as they are captured.
+
+    The corners tracked by optical flow between two frames are reused to track the next one, they are only detected
+    again once fewer than `min_corners` of them survive. The transform from the first frame is accumulated along the
+    way, the stabilized frames are written into `output` (a `FrameRingBuffer`).
+    """
+
+    def __init__(self, output, min_corners=50, writer=None):
+        self.output = output
+        self.min_corners = min_corners
+        self.writer = writer
+        self.reset()
+
+    def reset(self):
+        self.output.clear()
+        self.prev_gray = None
+        self.prev_corners = None
+
+        # Accumulated frame transforms.
+        self.acc_dx = 0
+        self.acc_dy = 0
+        self.acc_da = 0
+        self.acc_transform = numpy.eye(3, dtype=numpy.float32)
+
+        # Highest translations (left/right, top/bottom), used to compute a mask
+        self.min_acc_dx = 0
+        self.max_acc_dx = 0
+        self.min_acc_dy = 0
+        self.max_acc_dy = 0
+
+    def add(self, cur):
+        """Stabilizes `cur` into `output`, returns the stabilized frame or None if it had to be skipped."""
+        cur_gray = cv2.cvtColor(cur, cv2.COLOR_RGB2GRAY)
+
+        if self.prev_gray is None:
+            # The first frame is the reference.
+            self.prev_gray = cur_gray
+            return self.output.commit(cur)
+
+        prev_gray = self.prev_gray
+        self.prev_gray = cur_gray
+
+        if self.prev_corners is None or len(self.prev_corners) < self.min_corners:
+            self.prev_corners = cv2.goodFeaturesToTrack(prev_gray, maxCorners=200, qualityLevel=.01, minDistance=10) # FIXME: What are these constants?
+        if self.prev_corners is None:
+            log.warning("stabilize: could not find prev_corner, skipping frame")
+            return None
+
+        cur_corners, status, err = cv2.calcOpticalFlowPyrLK(prev_gray, cur_gray, self.prev_corners, None)
+
+        # weed out bad matches
+        tracked = status.ravel() == 1
+        prev_corners = self.prev_corners[tracked]
+        cur_corners = cur_corners[tracked]
+        # The corners that survived are tracked from this frame to the next one.
+        self.prev_corners = cur_corners if len(cur_corners) > 0 else None
+
+        # Compute transformation between frames, as a combination of translations, rotations, uniform scaling.
+        transform = estimate_rigid_transform(prev_corners, cur_corners) if len(cur_corners) > 0 else None
+        if transform is None:
+            log.warning("stabilize: could not find transform, skipping frame")
+            return None
+
+        dx = transform[0, 2]
+        dy = transform[1, 2]
+
+        if dx == 0. and dy == 0.:
+            log.debug("stabilize: dx and dy are 0")
+            # For some reason I don't understand yet, if both dx and dy are 0,
+            # our matrix multiplication doesn't seem to make sense.
+            result = self.output.commit(cur)
+        else:
+            da = math.atan2(transform[1, 0], transform[0, 0])
+
+            self.acc_dx += dx
+            if self.acc_dx > self.max_acc_dx:
+                self.max_acc_dx = self.acc_dx
+            elif self.acc_dx < self.min_acc_dx:
+                self.min_acc_dx = self.acc_dx
+
+            self.acc_dy += dy
+            if self.acc_dy > self.max_acc_dy:
+                self.max_acc_dy = self.acc_dy
+            elif self.acc_dy < self.min_acc_dy:
+                self.min_acc_dy = self.acc_dy
+
+            self.acc_da += da
+
+            padded_transform = numpy.eye(3, dtype=numpy.float32)
+            padded_transform[:2] = transform
+            self.acc_transform = numpy.dot(self.acc_transform, padded_transform)
+
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("stabilize: current transform\n %s", transform)
+                log.debug("stabilize: padded transform\n %s", padded_transform)
+                log.debug("stabilize: full transform\n %s", self.acc_transform)
+                log.debug("stabilize: resized full transform\n %s", numpy.round(self.acc_transform[0:2, :]))
+            # Warp straight into the output buffer.
+            height, width = cur.shape[:2]
+            slot = self.output.next_slot()
+            if slot.shape != cur.shape:
+                slot = None
+            result = self.output.commit(cv2.warpAffine(cur, numpy.round(self.acc_transform[0:2,:]), (width, height), dst=slot))
+
+        if self.writer:
+            self.writer.write(result)
+
+        return result
+
+
+def stabilize(frames):
+    """Stabilizes a list of frames at once."""
+    stabilized_writer = None
     if args['dump_stabilized']:
         stabilized_writer = cv2.VideoWriter(args['dump_stabilized'], cv2.VideoWriter_fourcc(*"DIVX"), 16, (args['width'], args['height']));
 
     # Stabilize image, most likely introducing borders.
-    stabilized.append(prev)
-    for cur in frames[1:]:
-        cur_gray = cv2.cvtColor(cur, cv2.COLOR_RGB2GRAY)
+    stabilizer = Stabilizer(FrameRingBuffer(len(frames), frames[0].shape), writer=stabilized_writer)
+    for cur in frames:
+        stabilizer.add(cur)
 
-        prev_corner = cv2.goodFeaturesToTrack(prev_gray, maxCorners=200, qualityLevel=.01, minDistance=10) # FIXME: What are these constants?
-        if not (prev_corner is None):
-            # FIXME: Really, what should we do if `prev_corner` is `None`?
-            cur_corner, status, err = cv2.calcOpticalFlowPyrLK(prev_gray, cur_gray, prev_corner, None)
-            should_copy = [bool(x) for x in status]
-
-            # weed out bad matches
-            # FIXME: I'm sure that there is a more idiomatic way to do this in Python
-            corners = len(should_copy)
-            prev_corner2 = numpy.zeros((corners, 1, 2), numpy.float32)
-            cur_corner2 = numpy.zeros((corners, 1, 2), numpy.float32)
-
-            j = 0
-            for i in range(len(status)):
-                if status[i]:
-                    prev_corner2[j] = prev_corner[i]
-                    cur_corner2[j] = cur_corner[i]
-                    j += 1
-            prev_corner = None
-            cur_corner = None
-
-
-            # Compute transformation between frames, as a combination of translations, rotations, uniform scaling.
-            transform = cv2.estimateRigidTransform(prev_corner2, cur_corner2, False)
-            if transform is None:
-                print("stabilize: could not find transform, skipping frame")
-            else:
-                dx = transform[0, 2]
-                dy = transform[1, 2]
-
-                result = None
-
-                if dx == 0. and dy == 0.:
-                    print("stabilize: dx and dy are 0")
-                    # For some reason I don't understand yet, if both dx and dy are 0,
-                    # our matrix multiplication doesn't seem to make sense.
-                    result = cur
-                else:
-                    da = math.atan2(transform[1, 0], transform[0, 0])
-
-                    acc_dx += dx
-                    if acc_dx > max_acc_dx:
-                        max_acc_dx = acc_dx
-                    elif acc_dx < min_acc_dx:
-                        min_acc_dx = acc_dx
-
-                    acc_dy += dy
-                    if acc_dy > max_acc_dy:
-                        max_acc_dy = acc_dy
-                    elif acc_dy < min_acc_dy:
-                        min_acc_dy = acc_dy
-
-                    acc_da += da
-
-                    padded_transform = numpy.zeros((3, 3), numpy.float32)
-                    for i in range(2):
-                        for j in range(3):
-                            padded_transform[i,j] = transform[i,j]
-                    padded_transform[2, 2] = 1
-                    acc_transform = numpy.dot(acc_transform, padded_transform)
-
-                    print("stabilize: current transform\n %s" % transform)
-                    print("stabilize: padded transform\n %s" % padded_transform)
-                    print("stabilize: full transform\n %s" % acc_transform)
-                    print("stabilize: resized full transform\n %s" % numpy.round(acc_transform[0:2, :]))
-                    result = cv2.warpAffine(cur, numpy.round(acc_transform[0:2,:]), (args['width'], args['height']), cv2.INTER_NEAREST)
-                stabilized.append(result)
-
-                if stabilized_writer:
-                    stabilized_writer.write(result)
-        else:
-            print("stabilize: could not find prev_corner, skipping frame")
+    return crop(stabilizer.output.views())
 
-        prev = cur
-        prev_gray = cur_gray
 
+def crop(stabilized):
     # Now crop all images to remove these borders.
     cropped = []
     for frame in stabilized:
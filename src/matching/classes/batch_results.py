@@ -0,0 +1,63 @@
+import csv
+import glob
+import json
+import os
+
+from .feature_extractor import FeatureExtractor
+
+
+def list_templates(templates):
+    """Paths of the templates described by `templates`: a folder, a glob pattern or a file listing one path per line."""
+    if os.path.isdir(templates):
+        return FeatureExtractor.list_images(templates)
+
+    if os.path.isfile(templates):
+        with open(templates, 'r') as input_file:
+            return [line.strip() for line in input_file if line.strip() and not line.startswith('#')]
+
+    return sorted(glob.glob(templates))
+
+
+class BatchResultWriter:
+    """Streams the best matches of every template to a file, as JSON lines or CSV rows.
+
+    Templates that could not be matched get a single line or row with an `error` instead.
+    """
+
+    CSV_COLUMNS = ['template', 'rank', 'key', 'matches', 'good_matches', 'histogram', 'score', 'error']
+
+    def __init__(self, output_path, output_format):
+        self.output_format = output_format
+        self.output_file = open(output_path, 'w', newline='')
+        self.csv_writer = None
+        if output_format == 'csv':
+            self.csv_writer = csv.writer(self.output_file)
+            self.csv_writer.writerow(self.CSV_COLUMNS)
+
+    def write(self, template, matches):
+        if self.csv_writer is not None:
+            for rank, match in enumerate(matches):
+                row = [template, rank + 1] + [match[column] for column in self.CSV_COLUMNS[2:-1]]
+                self.csv_writer.writerow(row + [''])
+        else:
+            self.output_file.write(json.dumps(dict(template=template, matches=matches)) + '\n')
+
+        # Results are consumed while the batch is still running.
+        self.output_file.flush()
+
+    def write_error(self, template, error):
+        if self.csv_writer is not None:
+            self.csv_writer.writerow([template] + [''] * (len(self.CSV_COLUMNS) - 2) + [error])
+        else:
+            self.output_file.write(json.dumps(dict(template=template, error=error)) + '\n')
+
+        self.output_file.flush()
+
+    def close(self):
+        self.output_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        self.close()
@@ -0,0 +1,241 @@
+import cv2
+import json
+import os
+import time
+
+import numpy
+
+from .feature_database import FeatureDatabase, is_feature_database
+from .vocabulary_index import VocabularyIndex
+
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+
+# Version of the files written by `CatalogIndex.save`, bump it whenever their content changes.
+INDEX_FORMAT_VERSION = 1
+
+
+def get_flann_params(norm):
+    if norm == cv2.NORM_HAMMING:
+        return dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+    else:
+        return dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+
+
+def get_norm(detector_type):
+    return cv2.NORM_L2 if detector_type == 'surf' else cv2.NORM_HAMMING
+
+
+def get_index_path(database_path):
+    # The FLANN index of a feature database is stored next to it.
+    return database_path + '.flann'
+
+
+def load_or_build(image_descriptions, norm, data_path, matcher_type, catalog_index=False, neighbours=8,
+                  vocabulary_branching=10, vocabulary_depth=4):
+    """Loads the indexes stored next to the feature database `data_path` (if it is one), or builds them.
+
+    Returns the `CatalogIndex` (if `catalog_index` is set) and the `VocabularyIndex` (with the 'vocabulary' matcher)
+    of the catalog, `None` otherwise.
+    """
+    database = None
+    if (catalog_index or matcher_type == 'vocabulary') and data_path is not None and is_feature_database(data_path):
+        database = FeatureDatabase.open(data_path)
+
+    index = None
+    if catalog_index:
+        index_start = time.time()
+        index = CatalogIndex(image_descriptions, norm, matcher_type, neighbours, database)
+
+        if index.index_source == 'rebuilt':
+            print('\033[93mWarning: the index stored next to "{}" does not match it or the matcher options, '
+                  'rebuilding it.\033[0m'.format(data_path))
+
+        print("\033[94mCatalog index has been %s in %s seconds.\033[0m" % (index.index_source or 'built',
+                                                                         time.time() - index_start))
+
+    vocabulary_index = None
+    if matcher_type == 'vocabulary':
+        vocabulary_start = time.time()
+        vocabulary_index = VocabularyIndex.open(image_descriptions, norm, database, vocabulary_branching,
+                                                vocabulary_depth)
+
+        if vocabulary_index.index_source == 'rebuilt':
+            print('\033[93mWarning: the vocabulary index stored next to "{}" does not match it or the vocabulary '
+                  'options, rebuilding it.\033[0m'.format(data_path))
+
+        print("\033[94mVocabulary index has been %s in %s seconds.\033[0m" % (vocabulary_index.index_source,
+                                                                           time.time() - vocabulary_start))
+
+    return index, vocabulary_index
+
+
+class CatalogIndex:
+    """Nearest neighbour index over the descriptors of all the images of a catalog.
+
+    The descriptors of every image are stacked into one train set, searched with a single kNN query per template
+    instead of one matcher call (and, for FLANN, one index build) per image. Results are then grouped per image for
+    the ratio test, which is only approximately the one of images matched on their own: see `nearest_per_image`.
+    """
+
+    def __init__(self, image_descriptions, norm, matcher_type, neighbours=8, database=None):
+        self.image_descriptions = image_descriptions
+        self.norm = norm
+        self.matcher_type = matcher_type
+        # Number of neighbours retrieved across the whole catalog for every template descriptor. The two nearest
+        # descriptors of an image are only seen if they are among them.
+        self.neighbours = neighbours
+
+        blocks = [image_description.descriptors for image_description in image_descriptions
+                  if image_description.descriptors is not None]
+        counts = [0 if image_description.descriptors is None else len(image_description.descriptors)
+                  for image_description in image_descriptions]
+
+        # Row `i` of `train_descriptors` is descriptor `i - image_offsets[row_images[i]]` of image `row_images[i]`.
+        if not blocks:
+            self.train_descriptors = None
+        elif database is not None:
+            # The images of a feature database are already stacked in the same order, use the mapping directly.
+            self.train_descriptors = database.descriptors
+        else:
+            self.train_descriptors = numpy.ascontiguousarray(numpy.concatenate(blocks))
+        self.row_images = numpy.repeat(numpy.arange(len(image_descriptions), dtype=numpy.int32), counts)
+        self.image_offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1])).astype(numpy.int32)
+
+        # Where the FLANN index comes from: 'built', 'loaded' from the files written by `save`, or 'rebuilt' because
+        # these files do not match the database any more.
+        self.index_source = None
+        self.flann_index = None
+        if matcher_type == 'flann' and self.train_descriptors is not None:
+            if database is not None and os.path.exists(get_index_path(database.path) + '.json'):
+                if self.load(database):
+                    self.index_source = 'loaded' if self.is_index_stored() else 'built'
+                else:
+                    self.index_source = 'rebuilt'
+            else:
+                self.index_source = 'built'
+
+            if self.flann_index is None:
+                self.flann_index = cv2.flann_Index(self.train_descriptors, get_flann_params(norm))
+
+    def __len__(self):
+        return len(self.image_descriptions)
+
+    def is_index_stored(self):
+        # OpenCV does not store LSH tables (it rebuilds them on load, which is cheap) and fails to load the files it
+        # writes for them: only the KD-tree itself is persisted, LSH indexes only get their options checked.
+        return self.norm != cv2.NORM_HAMMING
+
+    def describe_index(self, database):
+        return dict(format=INDEX_FORMAT_VERSION, database=database.version, rows=len(self.row_images),
+                    params=get_flann_params(self.norm), opencv=cv2.__version__, stored=self.is_index_stored())
+
+    def save(self, database):
+        """Writes the FLANN index next to `database`, with the options it has been built with."""
+        index_path = get_index_path(database.path)
+        if self.is_index_stored():
+            self.flann_index.save(index_path)
+        elif os.path.exists(index_path):
+            os.remove(index_path)
+
+        with open(index_path + '.json', 'w') as output_file:
+            json.dump(self.describe_index(database), output_file)
+
+    def load(self, database):
+        """Loads the FLANN index saved next to `database`.
+
+        Returns `False`, leaving the index to be built, when it has been saved for another version of the database
+        or with other options.
+        """
+        index_path = get_index_path(database.path)
+        with open(index_path + '.json', 'r') as input_file:
+            if json.load(input_file) != self.describe_index(database):
+                return False
+
+        if self.is_index_stored():
+            flann_index = cv2.flann_Index()
+            if not flann_index.load(self.train_descriptors, index_path):
+                return False
+            self.flann_index = flann_index
+
+        return True
+
+    def knn_search(self, query_descriptors, k):
+        """Returns the rows of the `k` nearest train descriptors of every query descriptor, and their distances.
+
+        Both arrays have a shape of (number of query descriptors, k), sorted by increasing distance. Missing
+        neighbours have a row of -1.
+        """
+        k = min(k, len(self.row_images))
+
+        if self.flann_index is not None:
+            rows, distances = self.flann_index.knnSearch(query_descriptors, k, params={})
+            distances = distances.astype(numpy.float32)
+            if self.norm != cv2.NORM_HAMMING:
+                # The KD-tree reports squared euclidean distances.
+                distances = numpy.sqrt(distances)
+        else:
+            distance_type = cv2.CV_32S if self.norm == cv2.NORM_HAMMING else cv2.CV_32F
+            distances, rows = cv2.batchDistance(query_descriptors, self.train_descriptors, distance_type,
+                                                normType=self.norm, K=k)
+            distances = distances.astype(numpy.float32)
+
+        return rows.reshape(-1, k), distances.reshape(-1, k)
+
+    def nearest_per_image(self, query_descriptors):
+        """Groups the catalog-wide neighbours of every query descriptor per image.
+
+        Returns three arrays of shape (number of images, number of query descriptors): the distance of the nearest
+        and second nearest descriptor of each image (`inf` when the image is not among the neighbours) and the index
+        of the nearest descriptor within the image (-1 when missing).
+
+        When only one descriptor of an image is among the `neighbours` nearest ones, its second nearest one lies
+        beyond them: both are then searched again among the descriptors of that image only, as when matching images
+        on their own. Images none of whose descriptors are among the neighbours are not matched at all, where on
+        their own they could pass the ratio test: raising `neighbours` brings the results closer to the per-image
+        ones, at the cost of a larger search.
+        """
+        query_count = len(query_descriptors)
+        first_distances = numpy.full((len(self), query_count), numpy.inf, dtype=numpy.float32)
+        second_distances = numpy.full((len(self), query_count), numpy.inf, dtype=numpy.float32)
+        first_indices = numpy.full((len(self), query_count), -1, dtype=numpy.int32)
+
+        if self.train_descriptors is None or query_count == 0:
+            return first_distances, second_distances, first_indices
+
+        rows, distances = self.knn_search(query_descriptors, self.neighbours)
+        found = rows >= 0
+        images = numpy.where(found, self.row_images[numpy.maximum(rows, 0)], -1)
+        queries = numpy.arange(query_count)
+
+        # Neighbours are sorted by distance: for every column, the number of earlier columns holding the same image
+        # tells whether it is the nearest (0) or second nearest (1) descriptor of that image.
+        for column in range(rows.shape[1]):
+            image_column = images[:, column]
+            rank = (images[:, :column] == image_column[:, None]).sum(axis=1)
+
+            is_first = found[:, column] & (rank == 0)
+            first_distances[image_column[is_first], queries[is_first]] = distances[is_first, column]
+            first_indices[image_column[is_first], queries[is_first]] = \
+                rows[is_first, column] - self.image_offsets[image_column[is_first]]
+
+            is_second = found[:, column] & (rank == 1)
+            second_distances[image_column[is_second], queries[is_second]] = distances[is_second, column]
+
+        seen_once = numpy.isfinite(first_distances) & numpy.isinf(second_distances)
+        distance_type = cv2.CV_32S if self.norm == cv2.NORM_HAMMING else cv2.CV_32F
+        for image_index in numpy.flatnonzero(seen_once.any(axis=1)):
+            train_descriptors = self.image_descriptions[image_index].descriptors
+            if len(train_descriptors) < 2:
+                # No second nearest descriptor, the ratio test never passes.
+                continue
+
+            image_queries = numpy.flatnonzero(seen_once[image_index])
+            image_distances, image_indices = cv2.batchDistance(query_descriptors[image_queries], train_descriptors,
+                                                               distance_type, normType=self.norm, K=2)
+            image_distances = image_distances.astype(numpy.float32)
+            first_distances[image_index, image_queries] = image_distances[:, 0]
+            second_distances[image_index, image_queries] = image_distances[:, 1]
+            first_indices[image_index, image_queries] = image_indices[:, 0]
+
+        return first_distances, second_distances, first_indices
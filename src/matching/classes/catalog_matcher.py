@@ -0,0 +1,221 @@
+import cv2
+import numpy
+
+from .catalog_index import get_flann_params
+from .image_description import HISTOGRAM_SIZE
+from .instrumentation import instrumentation
+
+
+def histogram_correlations(histogram, histograms):
+    """Same as `cv2.compareHist(histogram, row, cv2.HISTCMP_CORREL)` for every row of `histograms`, at once."""
+    histogram = numpy.asarray(histogram, dtype=numpy.float64).ravel()
+    histograms = numpy.asarray(histograms, dtype=numpy.float64).reshape(-1, len(histogram))
+
+    centered = histogram - histogram.mean()
+    centered_rows = histograms - histograms.mean(axis=1, keepdims=True)
+
+    numerator = centered_rows.dot(centered)
+    denominator = numpy.sqrt((centered_rows ** 2).sum(axis=1) * (centered ** 2).sum())
+
+    # OpenCV reports a perfect correlation when one of the histograms is flat.
+    correlations = numpy.ones(len(histograms))
+    numpy.divide(numerator, denominator, out=correlations, where=denominator > numpy.finfo(numpy.float64).eps)
+
+    return correlations
+
+
+class MatchResult:
+    """Outcome of matching one template against every image of a catalog, as arrays indexed by image."""
+
+    def __init__(self, matches_count, good, first_distances, first_indices, histogram_correlations, candidates):
+        # Number of template descriptors that have been matched against every image.
+        self.matches_count = matches_count
+        # Mask of the images whose descriptors have been matched, the others only have a histogram correlation.
+        self.candidates = candidates
+        # (number of images, number of template descriptors) mask of the matches passing the ratio test.
+        self.good = good
+        self.first_distances = first_distances
+        self.first_indices = first_indices
+        self.histogram_correlations = histogram_correlations
+
+        self.good_counts = good.sum(axis=1)
+        self.scores = (self.good_counts / float(matches_count) if matches_count else
+                       numpy.zeros(len(good))) + 0.01 * histogram_correlations
+
+    def ranking(self):
+        # Indices of the images by decreasing score, ties kept in catalog order.
+        return numpy.argsort(-self.scores, kind='stable')
+
+    def top(self, image_descriptions, n=None):
+        """The `n` best matches (all of them by default), best first, as plain dictionaries."""
+        return [dict(key=image_descriptions[image_index].key, matches=int(self.matches_count),
+                     good_matches=int(self.good_counts[image_index]),
+                     histogram=float(self.histogram_correlations[image_index]),
+                     score=float(self.scores[image_index])) for image_index in self.ranking()[:n]]
+
+    def recall(self, reference, n):
+        """Proportion of the `n` best images of `reference` (a full scan) that are also among the `n` best ones here."""
+        best = reference.ranking()[:n]
+        return len(numpy.intersect1d(best, self.ranking()[:n])) / float(len(best)) if len(best) else 1.
+
+    def good_matches(self, image_index):
+        # In the format expected by `cv2.drawMatchesKnn`.
+        return [[cv2.DMatch(int(query_index), int(self.first_indices[image_index, query_index]),
+                            float(self.first_distances[image_index, query_index]))]
+                for query_index in numpy.flatnonzero(self.good[image_index])]
+
+
+class CatalogMatcher:
+    """Matches templates against every image of a catalog and scores them with array operations.
+
+    The two nearest descriptors of every image are retrieved for all template descriptors (with one kNN call per
+    image, or a single one when a `CatalogIndex` is given), then the ratio test, the good match counts and the scores
+    combining them with the histogram correlation are computed for all images at once.
+
+    Optionally, histograms are compared first and descriptors are only matched against the `prefilter_top_k` images
+    whose histogram correlates best with the template's (and at least `prefilter_min_correlation`). With a
+    `VocabularyIndex`, descriptors are then only matched against the `shortlist_size` remaining images it ranks
+    first.
+    """
+
+    def __init__(self, image_descriptions, norm, matcher_type, catalog_index=None, prefilter_top_k=0,
+                 prefilter_min_correlation=None, vocabulary_index=None, shortlist_size=10):
+        self.image_descriptions = image_descriptions
+        self.norm = norm
+        self.matcher_type = matcher_type
+        self.catalog_index = catalog_index
+        self.prefilter_top_k = prefilter_top_k
+        self.prefilter_min_correlation = prefilter_min_correlation
+        self.vocabulary_index = vocabulary_index
+        self.shortlist_size = shortlist_size
+        self.histograms = numpy.array([image_description.histogram for image_description in image_descriptions],
+                                      dtype=numpy.float32).reshape(len(image_descriptions), HISTOGRAM_SIZE)
+
+    def __len__(self):
+        return len(self.image_descriptions)
+
+    def is_prefiltering(self):
+        return self.prefilter_top_k > 0 or self.prefilter_min_correlation is not None or \
+            self.vocabulary_index is not None
+
+    def select_candidates(self, correlations, template_descriptors=None):
+        candidates = numpy.ones(len(self), dtype=bool)
+        if self.prefilter_min_correlation is not None:
+            candidates &= correlations >= self.prefilter_min_correlation
+        if 0 < self.prefilter_top_k < candidates.sum():
+            # Keep the best correlations among the remaining images, ties kept in catalog order.
+            order = numpy.argsort(-numpy.where(candidates, correlations, -numpy.inf), kind='stable')
+            candidates[:] = False
+            candidates[order[:self.prefilter_top_k]] = True
+        if self.vocabulary_index is not None:
+            with instrumentation.stage('match.vocabulary'):
+                candidates = self.vocabulary_index.shortlist(template_descriptors, self.shortlist_size, candidates)
+
+        return candidates
+
+    def nearest_per_image(self, query_descriptors, candidates=None):
+        """Same as `CatalogIndex.nearest_per_image`, matching every image on its own if there is no catalog index.
+
+        If a `candidates` mask is given, the other images are not matched at all (unless the catalog index is used,
+        which searches all images in one go).
+        """
+        if self.catalog_index is not None:
+            return self.catalog_index.nearest_per_image(query_descriptors)
+
+        query_count = len(query_descriptors)
+        first_distances = numpy.full((len(self), query_count), numpy.inf, dtype=numpy.float32)
+        second_distances = numpy.full((len(self), query_count), numpy.inf, dtype=numpy.float32)
+        first_indices = numpy.full((len(self), query_count), -1, dtype=numpy.int32)
+
+        distance_type = cv2.CV_32S if self.norm == cv2.NORM_HAMMING else cv2.CV_32F
+
+        image_indices = range(len(self)) if candidates is None else numpy.flatnonzero(candidates)
+        for image_index in image_indices:
+            train_descriptors = self.image_descriptions[image_index].descriptors
+            if train_descriptors is None or len(train_descriptors) == 0 or query_count == 0:
+                continue
+
+            k = min(2, len(train_descriptors))
+            if self.matcher_type == 'flann':
+                flann_index = cv2.flann_Index(train_descriptors, get_flann_params(self.norm))
+                indices, distances = flann_index.knnSearch(query_descriptors, k, params={})
+                if self.norm != cv2.NORM_HAMMING:
+                    # The KD-tree reports squared euclidean distances.
+                    distances = numpy.sqrt(distances)
+            else:
+                # Brute-force, also used for the short list of the vocabulary index.
+                distances, indices = cv2.batchDistance(query_descriptors, train_descriptors, distance_type,
+                                                       normType=self.norm, K=k)
+
+            indices = indices.reshape(query_count, k)
+            distances = numpy.where(indices >= 0, distances.reshape(query_count, k), numpy.inf)
+
+            first_distances[image_index] = distances[:, 0]
+            first_indices[image_index] = indices[:, 0]
+            if k == 2:
+                second_distances[image_index] = distances[:, 1]
+
+        return first_distances, second_distances, first_indices
+
+    def match(self, template_descriptors, template_histogram, ratio_test_coefficient, prefilter=True):
+        if template_descriptors is None:
+            template_descriptors = numpy.zeros((0, 0), dtype=numpy.uint8)
+
+        with instrumentation.stage('match.histogram'):
+            correlations = histogram_correlations(template_histogram, self.histograms)
+
+        candidates = None
+        if prefilter and self.is_prefiltering():
+            candidates = self.select_candidates(correlations, template_descriptors)
+
+        with instrumentation.stage('match.knn'):
+            first_distances, second_distances, first_indices = self.nearest_per_image(template_descriptors, candidates)
+
+        # Apply ratio test. Images with a single descriptor have no second nearest one and never pass it.
+        with instrumentation.stage('match.ratio_test'):
+            good = numpy.isfinite(second_distances) & (first_distances < ratio_test_coefficient * second_distances)
+
+            if candidates is None:
+                candidates = numpy.ones(len(self), dtype=bool)
+            else:
+                good &= candidates[:, None]
+
+        instrumentation.count('templates matched')
+        instrumentation.count('images matched', int(candidates.sum()))
+
+        return MatchResult(len(template_descriptors), good, first_distances, first_indices, correlations, candidates)
+
+    def match_batch(self, templates, ratio_test_coefficient):
+        """Matches several `(descriptors, histogram)` templates at once, returns a `MatchResult` for each of them.
+
+        The descriptors of all templates are stacked into a single query, so the catalog is searched once per batch
+        rather than once per template.
+        """
+        if self.is_prefiltering():
+            # Candidates differ from one template to the other.
+            return [self.match(descriptors, histogram, ratio_test_coefficient) for descriptors, histogram in templates]
+
+        counts = [0 if descriptors is None else len(descriptors) for descriptors, histogram in templates]
+        blocks = [descriptors for descriptors, histogram in templates if descriptors is not None and len(descriptors)]
+        if not blocks:
+            return [self.match(None, histogram, ratio_test_coefficient) for descriptors, histogram in templates]
+
+        with instrumentation.stage('match.knn'):
+            first_distances, second_distances, first_indices = self.nearest_per_image(numpy.concatenate(blocks))
+        with instrumentation.stage('match.ratio_test'):
+            good = numpy.isfinite(second_distances) & (first_distances < ratio_test_coefficient * second_distances)
+        candidates = numpy.ones(len(self), dtype=bool)
+
+        match_results = []
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+        for template_index, (descriptors, histogram) in enumerate(templates):
+            columns = slice(offsets[template_index], offsets[template_index + 1])
+            with instrumentation.stage('match.histogram'):
+                correlations = histogram_correlations(histogram, self.histograms)
+            match_results.append(MatchResult(counts[template_index], good[:, columns], first_distances[:, columns],
+                                             first_indices[:, columns], correlations, candidates))
+
+        instrumentation.count('templates matched', len(templates))
+        instrumentation.count('images matched', len(templates) * len(self))
+
+        return match_results
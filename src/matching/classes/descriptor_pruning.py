@@ -0,0 +1,103 @@
+import numpy
+
+from .catalog_index import CatalogIndex
+from .image_description import ImageDescription
+from .instrumentation import instrumentation
+
+
+class DescriptorPruner:
+    """Drops the descriptors of a catalog that are the least likely to help telling its images apart.
+
+    The nearest neighbours of every descriptor are searched among all the descriptors of the catalog, then, image by
+    image, descriptors are dropped when they are:
+
+    - ambiguous: another image has a descriptor within `ambiguity_distance` (logos, barcodes, text shared by several
+      products give good matches with all of them),
+    - redundant: a descriptor already kept for the same image lies within `redundancy_distance` (it would be the
+      second nearest neighbour of the other one, making both fail the ratio test),
+    - over budget: only the `budget` most distinctive descriptors of every image are kept, the distinctiveness of a
+      descriptor being its distance to the nearest descriptor of another image.
+
+    A value of 0 disables a rule. Kept descriptors stay in their original order.
+    """
+
+    def __init__(self, norm, budget=0, ambiguity_distance=0, redundancy_distance=0, matcher_type='flann',
+                 neighbours=16):
+        self.norm = norm
+        self.budget = budget
+        self.ambiguity_distance = ambiguity_distance
+        self.redundancy_distance = redundancy_distance
+        self.matcher_type = matcher_type
+        # Number of neighbours retrieved across the catalog for every descriptor.
+        self.neighbours = neighbours
+        self.counters = dict(ambiguous=0, redundant=0, budget=0, kept=0)
+
+    def is_enabled(self):
+        return self.budget > 0 or self.ambiguity_distance > 0 or self.redundancy_distance > 0
+
+    def describe_options(self):
+        # Stored in the metadata of the feature database.
+        return dict(budget=self.budget, ambiguity_distance=self.ambiguity_distance,
+                    redundancy_distance=self.redundancy_distance)
+
+    def describe_counters(self):
+        return 'kept: {kept}, dropped as ambiguous: {ambiguous}, redundant: {redundant}, over budget: ' \
+               '{budget}'.format(**self.counters)
+
+    def prune(self, image_descriptions):
+        """Returns new image descriptions holding the kept descriptors only."""
+        catalog_index = CatalogIndex(image_descriptions, self.norm, self.matcher_type, self.neighbours)
+        if catalog_index.train_descriptors is None:
+            return image_descriptions
+
+        with instrumentation.stage('prune.knn'):
+            rows, distances = catalog_index.knn_search(catalog_index.train_descriptors, self.neighbours)
+
+        with instrumentation.stage('prune.select'):
+            found = rows >= 0
+            row_images = catalog_index.row_images
+            same_image = found & (row_images[numpy.maximum(rows, 0)] == row_images[:, None])
+            other_image = found & ~same_image
+            is_self = rows == numpy.arange(len(rows))[:, None]
+
+            # Descriptors with no neighbour in another image are the most distinctive ones.
+            distinctiveness = numpy.where(other_image, distances, numpy.inf).min(axis=1)
+            close_neighbours = same_image & ~is_self & (distances <= self.redundancy_distance)
+
+            kept = numpy.zeros(len(rows), dtype=bool)
+            pruned_descriptions = []
+            for image_index, image_description in enumerate(image_descriptions):
+                descriptors = image_description.descriptors
+                if descriptors is None or len(descriptors) == 0:
+                    pruned_descriptions.append(image_description)
+                    continue
+
+                image_rows = catalog_index.image_offsets[image_index] + numpy.arange(len(descriptors))
+                if self.ambiguity_distance > 0:
+                    ambiguous = distinctiveness[image_rows] <= self.ambiguity_distance
+                    self.counters['ambiguous'] += int(ambiguous.sum())
+                    image_rows = image_rows[~ambiguous]
+
+                # Most distinctive first, in their original order among equals.
+                image_rows = image_rows[numpy.argsort(-distinctiveness[image_rows], kind='stable')]
+
+                kept_count = 0
+                for row in image_rows:
+                    if self.budget > 0 and kept_count >= self.budget:
+                        self.counters['budget'] += 1
+                        continue
+                    if self.redundancy_distance > 0 and kept[rows[row][close_neighbours[row]]].any():
+                        self.counters['redundant'] += 1
+                        continue
+                    kept[row] = True
+                    kept_count += 1
+
+                self.counters['kept'] += kept_count
+                image_kept = kept[catalog_index.image_offsets[image_index]:
+                                  catalog_index.image_offsets[image_index] + len(descriptors)]
+                # Same convention as `detectAndCompute`, which returns `None` when nothing has been found.
+                pruned_descriptions.append(ImageDescription(image_description.key,
+                                                            descriptors[image_kept] if image_kept.any() else None,
+                                                            image_description.histogram))
+
+        return pruned_descriptions
@@ -0,0 +1,158 @@
+import json
+import os
+import struct
+import uuid
+
+import numpy
+
+from .image_description import HISTOGRAM_SIZE, ImageDescription
+
+# Binary layout of a feature database file:
+#
+#   magic (8 bytes) | format version (uint32) | header length (uint32)
+#   JSON header (keys, dtypes, shapes, metadata, section offsets), padded to SECTION_ALIGNMENT
+#   offsets section:    int64[count + 1], row range of every image in the descriptors section
+#   histograms section: histogram_dtype[count, histogram_size]
+#   descriptors section: descriptor_dtype[total_descriptors, descriptor_width]
+#
+# Every section starts on a SECTION_ALIGNMENT boundary so it can be opened directly with `numpy.memmap`.
+MAGIC = b'LHFDB\x00\x00\x00'
+FORMAT_VERSION = 1
+SECTION_ALIGNMENT = 64
+
+_PRELUDE = struct.Struct('<8sII')
+
+
+def _align(position):
+    return (position + SECTION_ALIGNMENT - 1) // SECTION_ALIGNMENT * SECTION_ALIGNMENT
+
+
+def is_feature_database(path):
+    with open(path, 'rb') as input_file:
+        return input_file.read(len(MAGIC)) == MAGIC
+
+
+class FeatureDatabase:
+    """Memory-mapped store of the descriptors and histograms of a set of images.
+
+    All descriptors live in one contiguous block; `image_descriptions` are zero-copy views into it, so opening a
+    database does not depend on its size and processes that open the same file share its pages.
+    """
+
+    def __init__(self, path, header, offsets, histograms, descriptors):
+        self.path = path
+        self.header = header
+        self.offsets = offsets
+        self.histograms = histograms
+        self.descriptors = descriptors
+
+    @property
+    def keys(self):
+        return self.header['keys']
+
+    @property
+    def version(self):
+        # Unique identifier of this database, regenerated every time it is written.
+        return self.header.get('version')
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    def __len__(self):
+        return len(self.header['keys'])
+
+    def image_descriptions(self):
+        image_descriptions = []
+        for index, key in enumerate(self.header['keys']):
+            start, end = self.offsets[index], self.offsets[index + 1]
+            # Keep the same convention as `detectAndCompute`, which returns `None` when nothing has been found.
+            descriptors = self.descriptors[start:end] if end > start else None
+            image_descriptions.append(ImageDescription(key, descriptors, self.histograms[index]))
+
+        return image_descriptions
+
+    @staticmethod
+    def write(image_descriptions, output_path, metadata=None):
+        descriptor_blocks = [image_description.descriptors for image_description in image_descriptions
+                             if image_description.descriptors is not None and len(image_description.descriptors)]
+        if descriptor_blocks:
+            descriptor_dtype = descriptor_blocks[0].dtype
+            descriptor_width = descriptor_blocks[0].shape[1]
+        else:
+            descriptor_dtype = numpy.dtype(numpy.uint8)
+            descriptor_width = 0
+
+        # With an explicit width, an empty catalog gives a (0, HISTOGRAM_SIZE) array.
+        histograms = numpy.array([image_description.histogram for image_description in image_descriptions],
+                                 dtype=numpy.float32).reshape(len(image_descriptions), HISTOGRAM_SIZE)
+
+        offsets = numpy.zeros(len(image_descriptions) + 1, dtype=numpy.int64)
+        for index, image_description in enumerate(image_descriptions):
+            descriptors = image_description.descriptors
+            offsets[index + 1] = offsets[index] + (0 if descriptors is None else len(descriptors))
+
+        header = dict(keys=[image_description.key for image_description in image_descriptions],
+                      count=len(image_descriptions),
+                      descriptor_dtype=numpy.dtype(descriptor_dtype).str,
+                      descriptor_width=int(descriptor_width),
+                      total_descriptors=int(offsets[-1]),
+                      histogram_dtype=histograms.dtype.str,
+                      histogram_size=int(histograms.shape[1]),
+                      version=uuid.uuid4().hex,
+                      metadata=metadata or {})
+
+        # The header holds the section offsets, which depend on the header length: compute them against a
+        # placeholder first, then again once the length is known (it only grows by a few digits).
+        header['sections'] = dict(offsets=0, histograms=0, descriptors=0)
+        for _ in range(2):
+            position = _align(_PRELUDE.size + len(json.dumps(header).encode('utf-8')) + 64)
+            header['sections']['offsets'] = position
+            position = _align(position + offsets.nbytes)
+            header['sections']['histograms'] = position
+            position = _align(position + histograms.nbytes)
+            header['sections']['descriptors'] = position
+
+        encoded_header = json.dumps(header).encode('utf-8')
+
+        # Write to a temporary file first: other processes may have the current database mapped in memory.
+        temporary_path = output_path + '.tmp'
+        with open(temporary_path, 'wb') as output_file:
+            output_file.write(_PRELUDE.pack(MAGIC, FORMAT_VERSION, len(encoded_header)))
+            output_file.write(encoded_header)
+
+            for name, array in (('offsets', offsets), ('histograms', histograms)):
+                output_file.write(b'\x00' * (header['sections'][name] - output_file.tell()))
+                output_file.write(numpy.ascontiguousarray(array).tobytes())
+
+            output_file.write(b'\x00' * (header['sections']['descriptors'] - output_file.tell()))
+            for descriptors in descriptor_blocks:
+                output_file.write(numpy.ascontiguousarray(descriptors, dtype=descriptor_dtype).tobytes())
+
+        os.replace(temporary_path, output_path)
+
+    @staticmethod
+    def open(input_path):
+        with open(input_path, 'rb') as input_file:
+            magic, version, header_length = _PRELUDE.unpack(input_file.read(_PRELUDE.size))
+            if magic != MAGIC:
+                raise ValueError('"{}" is not a feature database.'.format(input_path))
+            if version != FORMAT_VERSION:
+                raise ValueError('"{}" uses feature database format version {}, expected {}.'.format(
+                    input_path, version, FORMAT_VERSION))
+            header = json.loads(input_file.read(header_length).decode('utf-8'))
+
+        sections = header['sections']
+        count = header['count']
+
+        def map_section(name, dtype, shape):
+            if numpy.prod(shape) == 0:
+                return numpy.empty(shape, dtype=dtype)
+            return numpy.memmap(input_path, dtype=dtype, mode='r', offset=sections[name], shape=shape)
+
+        offsets = map_section('offsets', numpy.int64, (count + 1,))
+        histograms = map_section('histograms', header['histogram_dtype'], (count, header['histogram_size']))
+        descriptors = map_section('descriptors', header['descriptor_dtype'],
+                                  (header['total_descriptors'], header['descriptor_width']))
+
+        return FeatureDatabase(input_path, header, offsets, histograms, descriptors)
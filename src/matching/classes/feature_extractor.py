@@ -2,77 +2,204 @@ import cv2
 import datetime
 import glob
 import json
+import multiprocessing
 import numpy
+import os
 
+from .feature_database import FeatureDatabase, is_feature_database
 from .image_description import ImageDescription
+from .instrumentation import instrumentation
+
+
+def create_detector(detector_type, options):
+    if detector_type == 'orb':
+        # Initialize the ORB descriptor, then detect keypoints and extract local invariant descriptors from the image.
+        return cv2.ORB_create(nfeatures=options['orb_n_features'])
+    elif detector_type == 'akaze':
+        return cv2.AKAZE_create(descriptor_channels=options['akaze_n_channels'])
+    else:
+        return cv2.xfeatures2d.SURF_create(hessianThreshold=options['surf_threshold'])
+
+
+def compute_histogram(image, mask=None):
+    # 8x8x8 colour histogram of a BGR image (of its pixels selected by `mask`, if any), flattened.
+    histogram = cv2.calcHist([image], [0, 1, 2], mask, [8, 8, 8], [0, 256, 0, 256, 0, 256])
+    return cv2.normalize(histogram, histogram).flatten()
+
+
+def describe_image(detector, image_path):
+    # Load the image, convert it to grayscale.
+    with instrumentation.stage('extract.load'):
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError('Unable to read image "{}"'.format(image_path))
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    with instrumentation.stage('extract.detect'):
+        (image_keypoints, image_descriptors) = detector.detectAndCompute(gray_image, None)
+
+    with instrumentation.stage('extract.histogram'):
+        image_histogram = compute_histogram(image)
+
+    instrumentation.count('images described')
+
+    return image_descriptors, image_histogram
+
+
+# State of an extraction worker process, set up once by `_initialize_worker`.
+_worker_detector = None
+
+
+def _initialize_worker(detector_type, options, instrumented, tracing):
+    global _worker_detector
+
+    # Parallelism comes from the processes, keep OpenCV from spawning its own threads in each of them.
+    cv2.setNumThreads(1)
+    _worker_detector = create_detector(detector_type, options)
+    if instrumented:
+        instrumentation.enable(tracing)
+
+
+def _describe_image_in_worker(image_path):
+    # The stages timed in the worker are sent back along with the result, or the error of an unreadable image.
+    try:
+        features = describe_image(_worker_detector, image_path)
+    except ValueError as error:
+        features = error
+    return features, instrumentation.collect()
 
 
 class FeatureExtractor:
-    def __init__(self, verbose):
+    def __init__(self, verbose, jobs=1):
         self.verbose = verbose
+        # Number of worker processes used to extract features.
+        self.jobs = jobs
+
+    @staticmethod
+    def list_images(image_set_path):
+        # Sorted, so that the database does not depend on the order of the directory entries.
+        return sorted(glob.glob(image_set_path + "/*.jpg"))
+
+    @staticmethod
+    def fingerprint(image_path):
+        # Cheap change detection: an image is considered unchanged as long as its modification time and size are.
+        stat = os.stat(image_path)
+        return [stat.st_mtime_ns, stat.st_size]
 
     def extract(self, image_set_path, detector_type, options):
-        if detector_type == 'orb':
-            # Initialize the ORB descriptor, then detect keypoints and extract local invariant descriptors from the
-            # image.
-            detector = cv2.ORB_create(nfeatures=options['orb_n_features'])
-        elif detector_type == 'akaze':
-            detector = cv2.AKAZE_create(descriptor_channels=options['akaze_n_channels'])
+        return self.extract_images(self.list_images(image_set_path), detector_type, options)
+
+    def extract_images(self, image_paths, detector_type, options, skip_unreadable=False):
+        """Describes the images of `image_paths`, in that order.
+
+        An image that cannot be read raises a `ValueError`, or is described by `None` with `skip_unreadable`.
+        """
+        if self.jobs > 1 and len(image_paths) > 1:
+            # Every worker builds its own detector once (see `_initialize_worker`); `imap` yields the results in the
+            # order of `image_paths`, whatever worker processed them.
+            pool = multiprocessing.Pool(min(self.jobs, len(image_paths)), initializer=_initialize_worker,
+                                        initargs=(detector_type, options, instrumentation.enabled,
+                                                  instrumentation.tracing))
+            try:
+                chunk_size = max(1, len(image_paths) // (self.jobs * 4))
+                image_features = []
+                for features, worker_instrumentation in pool.imap(_describe_image_in_worker, image_paths, chunk_size):
+                    image_features.append(features)
+                    instrumentation.merge(worker_instrumentation)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            detector = cv2.xfeatures2d.SURF_create(hessianThreshold=options['surf_threshold'])
+            detector = create_detector(detector_type, options)
+            image_features = []
+            for image_path in image_paths:
+                try:
+                    image_features.append(describe_image(detector, image_path))
+                except ValueError as error:
+                    image_features.append(error)
 
         image_descriptions = []
+        for image_path, features in zip(image_paths, image_features):
+            if isinstance(features, ValueError):
+                if not skip_unreadable:
+                    raise features
+                image_descriptions.append(None)
+            else:
+                image_descriptions.append(ImageDescription(image_path, *features))
+
+        if self.verbose:
+            print('All images processed ({} images): {:%H:%M:%S.%f}'.format(len(image_descriptions),
+                                                                            datetime.datetime.now()))
 
-        # loop over the images to find the template in
-        for image_set_path in glob.glob(image_set_path + "/*.jpg"):
-            # Load the image, convert it to grayscale.
-            image = cv2.imread(image_set_path)
-            gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image_descriptions
 
-            if self.verbose:
-                print('{} image loaded: {:%H:%M:%S.%f}'.format(image_set_path, datetime.datetime.now()))
+    def extract_incremental(self, image_set_path, detector_type, options, database_path, pruning=None):
+        """Extracts features of the images that changed since `database_path` was written, reuses the others.
+
+        Descriptions are only reused if they have been pruned with the same `pruning` options (see
+        `DescriptorPruner.describe_options`), or not at all when `pruning` is `None`. Returns the image descriptions
+        along with their fingerprints (see `fingerprint`).
+        """
+        image_paths = self.list_images(image_set_path)
+        fingerprints = dict((image_path, self.fingerprint(image_path)) for image_path in image_paths)
+
+        previous_keys = []
+        previous_descriptions = {}
+        if os.path.exists(database_path) and is_feature_database(database_path):
+            database = FeatureDatabase.open(database_path)
+            metadata = database.metadata
+            previous_keys = database.keys
+            if metadata.get('detector') == detector_type and metadata.get('options') == options and \
+                    metadata.get('pruning') == pruning:
+                previous_fingerprints = metadata.get('fingerprints', {})
+                for image_description in database.image_descriptions():
+                    if previous_fingerprints.get(image_description.key) == fingerprints.get(image_description.key):
+                        previous_descriptions[image_description.key] = image_description
+            elif self.verbose:
+                print('Detector or pruning options of "{}" differ, extracting everything: {:%H:%M:%S.%f}'.format(
+                    database_path, datetime.datetime.now()))
+
+        changed_paths = [image_path for image_path in image_paths if image_path not in previous_descriptions]
+        extracted_descriptions = dict((image_description.key, image_description) for image_description in
+                                      self.extract_images(changed_paths, detector_type, options))
 
-            (image_keypoints, image_descriptors) = detector.detectAndCompute(gray_image, None)
+        if self.verbose:
+            print('{} images reused, {} extracted, {} dropped: {:%H:%M:%S.%f}'.format(
+                len(image_paths) - len(changed_paths), len(changed_paths),
+                len(set(previous_keys) - set(fingerprints)), datetime.datetime.now()))
 
-            if self.verbose:
-                print('{} image\'s features are extracted: {:%H:%M:%S.%f}'.format(image_set_path,
-                                                                                  datetime.datetime.now()))
+        image_descriptions = [previous_descriptions.get(image_path) or extracted_descriptions[image_path]
+                              for image_path in image_paths]
 
-            image_histogram = cv2.calcHist([image], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-            image_histogram = cv2.normalize(image_histogram, image_histogram).flatten()
+        return image_descriptions, fingerprints
 
-            if self.verbose:
-                print('{} image\'s histogram calculated: {:%H:%M:%S.%f}'.format(image_set_path,
-                                                                                datetime.datetime.now()))
+    def serialize(self, image_descriptions, output_path, metadata=None):
+        if self.verbose:
+            print('Writing descriptions of {} images to file "{}" : {:%H:%M:%S.%f}'.format(len(image_descriptions),
+                                                                                         output_path,
+                                                                                         datetime.datetime.now()))
 
-            image_descriptions.append(ImageDescription(image_set_path, image_descriptors, image_histogram))
+        with instrumentation.stage('database.write'):
+            FeatureDatabase.write(image_descriptions, output_path, metadata)
 
         if self.verbose:
-            print('All images processed ({} images): {:%H:%M:%S.%f}'.format(len(image_descriptions),
-                                                                            datetime.datetime.now()))
+            print('All descriptions serialized: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
 
-        return image_descriptions
+    def deserialize(self, input_path):
+        if not is_feature_database(input_path):
+            return self.deserialize_json(input_path)
+
+        with instrumentation.stage('database.open'):
+            database = FeatureDatabase.open(input_path)
 
-    def serialize(self, image_descriptions, output_path):
-        serialized_image_descriptions = []
-
-        for image_description in image_descriptions:
-            if self.verbose:
-                print('Serializing descriptions for {} : {:%H:%M:%S.%f}'.format(image_description.key,
-                                                                                datetime.datetime.now()))
-            serialized_image_descriptions.append({'key': image_description.key,
-                                                  'histogram': dict(dtype=str(image_description.histogram.dtype),
-                                                                    content=image_description.histogram.tolist()),
-                                                  'descriptors': dict(dtype=str(image_description.descriptors.dtype),
-                                                                      content=image_description.descriptors.tolist())})
         if self.verbose:
-            print('All descriptions serialized, writing to file "{}" : {:%H:%M:%S.%f}'.format(output_path,
-                                                                                              datetime.datetime.now()))
+            print('Feature database mapped ({} records): {:%H:%M:%S.%f}'.format(len(database),
+                                                                               datetime.datetime.now()))
 
-        with open(output_path, 'w') as outfile:
-            json.dump(serialized_image_descriptions, outfile)
+        return database.image_descriptions()
 
-    def deserialize(self, input_path):
+    def deserialize_json(self, input_path):
+        # Legacy format, written by `serialize` before the binary feature database was introduced.
         with open(input_path, 'r') as input_file:
             serialized_image_descriptions = json.load(input_file)
 
@@ -82,9 +209,6 @@ class FeatureExtractor:
 
         image_descriptions = []
         for serialized_image_description in serialized_image_descriptions:
-            if self.verbose:
-                print('Deserializing descriptions for {} : {:%H:%M:%S.%f}'.format(serialized_image_description['key'],
-                                                                                  datetime.datetime.now()))
             descriptors = serialized_image_description['descriptors']
             histogram = serialized_image_description['histogram']
             image_descriptions.append(
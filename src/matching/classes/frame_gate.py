@@ -0,0 +1,68 @@
+import threading
+
+import cv2
+import numpy
+
+# Size of the thumbnails compared to detect near-duplicate frames.
+THUMBNAIL_SIZE = (64, 48)
+
+
+class FrameGate:
+    """Cheap checks rejecting the frames not worth matching, with a counter of the frames each of them dropped.
+
+    - sharpness: the variance of the Laplacian of the frame must be at least `min_sharpness` (blurred and dark frames
+      have a low one),
+    - duplicate: the mean absolute difference between the thumbnails of the frame and of the last accepted frame must
+      be at least `min_difference` grey levels,
+    - keypoints: at least `min_keypoints` keypoints must be detected.
+
+    A value of 0 disables a check. The first two run before feature extraction (`accept_frame`), the last one before
+    matching (`accept_keypoints`).
+    """
+
+    def __init__(self, min_sharpness=0, min_difference=0, min_keypoints=0):
+        self.min_sharpness = min_sharpness
+        self.min_difference = min_difference
+        self.min_keypoints = min_keypoints
+        self.last_thumbnail = None
+        self.counters = dict(sharpness=0, duplicate=0, keypoints=0, accepted=0)
+        # Keypoints are checked from the feature extraction threads.
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return self.min_sharpness > 0 or self.min_difference > 0 or self.min_keypoints > 0
+
+    def reject(self, gate):
+        with self.lock:
+            self.counters[gate] += 1
+        return False
+
+    def accept_frame(self, frame):
+        if self.min_sharpness <= 0 and self.min_difference <= 0:
+            return True
+
+        gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+        if self.min_sharpness > 0 and cv2.Laplacian(gray_frame, cv2.CV_64F).var() < self.min_sharpness:
+            return self.reject('sharpness')
+
+        if self.min_difference > 0:
+            thumbnail = cv2.resize(gray_frame, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(numpy.int16)
+            if self.last_thumbnail is not None and \
+                    numpy.abs(thumbnail - self.last_thumbnail).mean() < self.min_difference:
+                return self.reject('duplicate')
+            self.last_thumbnail = thumbnail
+
+        return True
+
+    def accept_keypoints(self, keypoints):
+        if self.min_keypoints > 0 and len(keypoints) < self.min_keypoints:
+            return self.reject('keypoints')
+
+        with self.lock:
+            self.counters['accepted'] += 1
+        return True
+
+    def describe_counters(self):
+        return 'accepted: {accepted}, dropped by sharpness: {sharpness}, duplicate: {duplicate}, keypoints: ' \
+               '{keypoints}'.format(**self.counters)
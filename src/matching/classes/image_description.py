@@ -1,3 +1,7 @@
+# Size of the colour histograms of the images: 8 bins per channel (see `compute_histogram`).
+HISTOGRAM_SIZE = 8 * 8 * 8
+
+
 class ImageDescription:
     def __init__(self, key, descriptors, histogram):
         self.key = key
@@ -0,0 +1,175 @@
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+
+# Number of histogram buckets per power of two.
+_BUCKETS_PER_OCTAVE = 4
+
+
+def _bucket_upper_bound(bucket):
+    # In microseconds.
+    return 2. ** ((bucket + 1.) / _BUCKETS_PER_OCTAVE)
+
+
+class _NoStage:
+    # Returned by `Instrumentation.stage` while disabled: timing a stage then costs a method call.
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage:
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception_info):
+        self.instrumentation.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+class Instrumentation:
+    """Named stage timers and counters, disabled (and almost free) until `enable` is called.
+
+    The durations of every stage are aggregated into a histogram of logarithmic buckets (four per power of two, so
+    that percentiles are within 19% of the actual value), along with their count, total, minimum and maximum. While
+    tracing, every stage is also kept as an event of a Chrome trace (chrome://tracing, Perfetto). Stages and counters
+    may be recorded from any thread; worker processes send theirs with `collect`, to be added to the main process ones
+    with `merge`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timers = {}
+        self.counters = collections.Counter()
+        self.events = []
+
+    def enable(self, tracing=False):
+        self.enabled = True
+        self.tracing = tracing
+
+    def stage(self, name):
+        """Context manager timing the stage `name`."""
+        return _Stage(self, name) if self.enabled else _NO_STAGE
+
+    def record(self, name, start, end):
+        duration = end - start
+        # Bucket `b` holds the durations in [2^(b / 4), 2^((b + 1) / 4)[ microseconds.
+        bucket = int(math.floor(math.log2(max(duration * 1e6, 1e-3)) * _BUCKETS_PER_OCTAVE))
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = dict(count=0, total=0., min=duration, max=duration, buckets={})
+            timer['count'] += 1
+            timer['total'] += duration
+            timer['min'] = min(timer['min'], duration)
+            timer['max'] = max(timer['max'], duration)
+            timer['buckets'][bucket] = timer['buckets'].get(bucket, 0) + 1
+
+            if self.tracing:
+                self.events.append(dict(name=name, ph='X', ts=start * 1e6, dur=duration * 1e6, pid=os.getpid(),
+                                        tid=threading.current_thread().ident))
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def collect(self):
+        """Returns everything recorded so far and starts again from scratch."""
+        with self.lock:
+            data = dict(timers=self.timers, counters=dict(self.counters), events=self.events)
+            self.reset()
+        return data
+
+    def merge(self, data):
+        with self.lock:
+            for name, other in data['timers'].items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.timers[name] = dict(other, buckets=dict(other['buckets']))
+                    continue
+                timer['count'] += other['count']
+                timer['total'] += other['total']
+                timer['min'] = min(timer['min'], other['min'])
+                timer['max'] = max(timer['max'], other['max'])
+                for bucket, count in other['buckets'].items():
+                    timer['buckets'][bucket] = timer['buckets'].get(bucket, 0) + count
+            self.counters.update(data['counters'])
+            self.events.extend(data['events'])
+
+    @staticmethod
+    def percentile(timer, proportion):
+        # Upper bound of the bucket holding the percentile, in seconds.
+        rank = proportion * timer['count']
+        seen = 0
+        for bucket in sorted(timer['buckets']):
+            seen += timer['buckets'][bucket]
+            if seen >= rank:
+                return min(_bucket_upper_bound(bucket) / 1e6, timer['max'])
+        return timer['max']
+
+    def to_dict(self):
+        timers = {}
+        for name, timer in self.timers.items():
+            timers[name] = dict(count=timer['count'], total_ms=timer['total'] * 1e3,
+                                mean_ms=timer['total'] / timer['count'] * 1e3, min_ms=timer['min'] * 1e3,
+                                max_ms=timer['max'] * 1e3,
+                                p50_ms=self.percentile(timer, .5) * 1e3, p90_ms=self.percentile(timer, .9) * 1e3,
+                                p99_ms=self.percentile(timer, .99) * 1e3,
+                                # (Upper bound of the bucket in microseconds, count) pairs, shortest first.
+                                histogram=[[round(_bucket_upper_bound(bucket), 3), count]
+                                           for bucket, count in sorted(timer['buckets'].items())])
+        return dict(timers=timers, counters=dict(self.counters))
+
+    def summary(self):
+        lines = ['%-28s %8s %11s %10s %10s %10s %10s' % ('stage', 'count', 'total (ms)', 'mean (ms)', 'p50 (ms)',
+                                                        'p90 (ms)', 'max (ms)')]
+        for name, timer in sorted(self.to_dict()['timers'].items()):
+            lines.append('%-28s %8d %11.1f %10.3f %10.3f %10.3f %10.3f' % (
+                name, timer['count'], timer['total_ms'], timer['mean_ms'], timer['p50_ms'], timer['p90_ms'],
+                timer['max_ms']))
+        for name, count in sorted(self.counters.items()):
+            lines.append('%-28s %8d' % (name, count))
+        return '\n'.join(lines)
+
+    def write_json(self, output_path):
+        with open(output_path, 'w') as output_file:
+            json.dump(self.to_dict(), output_file, indent=2, sort_keys=True)
+
+    def write_trace(self, output_path):
+        with open(output_path, 'w') as output_file:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit='ms'), output_file)
+
+    def report(self, summary=False, json_path=None, trace_path=None):
+        """Prints the summary table and/or writes the JSON dump and the Chrome trace, as requested."""
+        if summary:
+            print(self.summary())
+        if json_path:
+            self.write_json(json_path)
+        if trace_path:
+            self.write_trace(trace_path)
+
+
+# Shared by all the modules of a process.
+instrumentation = Instrumentation()
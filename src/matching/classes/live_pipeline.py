@@ -0,0 +1,168 @@
+import queue
+import threading
+import time
+
+from .instrumentation import instrumentation
+
+
+class FramePipeline:
+    """Matches the frames of a video source with capture, feature extraction and matching running concurrently.
+
+    One thread reads frames into a bounded queue, `jobs` threads describe them with `describe(frame, mask)` and `jobs`
+    other threads match the descriptions with `match(descriptors, histogram)`. OpenCV releases the GIL while it works,
+    so the stages overlap and several frames are processed at the same time.
+
+    With `drop_stale`, the capture thread never waits for the workers: when the queue is full, the oldest frame is
+    dropped so that the workers always get the most recent ones (use it for cameras, not for video files).
+
+    If given, `segment(frame)` runs in the capture thread (background subtraction needs the frames in order) and
+    returns the region of the frame to describe and its mask (or `None`). If given, the `FrameGate` `gate` drops the
+    frames not worth describing in the capture thread, and those with too few keypoints before matching.
+    """
+
+    def __init__(self, capture, describe, match, jobs=2, queue_size=2, drop_stale=True, segment=None, gate=None):
+        self.capture = capture
+        self.segment = segment
+        self.gate = gate
+        self.describe = describe
+        self.match = match
+        self.jobs = max(1, jobs)
+        self.drop_stale = drop_stale
+
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.descriptions = queue.Queue(maxsize=queue_size)
+        self.results = queue.Queue()
+        self.stopping = threading.Event()
+
+        self.captured_count = 0
+        self.dropped_count = 0
+
+    def _put(self, items, item):
+        # Blocks until there is room, unless the pipeline is being stopped.
+        while not self.stopping.is_set():
+            try:
+                items.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _capture(self):
+        frame_index = -1
+        try:
+            while not self.stopping.is_set():
+                ret, frame = self.capture.read()
+                if not ret:
+                    break
+
+                self.captured_count += 1
+                instrumentation.count('frames captured')
+                frame_index += 1
+                mask = None
+                if self.segment is not None:
+                    frame, mask = self.segment(frame)
+
+                if self.gate is not None and not self.gate.accept_frame(frame):
+                    continue
+
+                if not self.drop_stale:
+                    if not self._put(self.frames, (frame_index, frame, mask)):
+                        break
+                else:
+                    while True:
+                        try:
+                            self.frames.put_nowait((frame_index, frame, mask))
+                            break
+                        except queue.Full:
+                            try:
+                                self.frames.get_nowait()
+                                self.dropped_count += 1
+                                instrumentation.count('frames dropped (stale)')
+                            except queue.Empty:
+                                pass
+        finally:
+            for _ in range(self.jobs):
+                self._put(self.frames, None)
+
+    def _describe(self):
+        try:
+            while True:
+                item = self.frames.get()
+                if item is None:
+                    break
+
+                frame_index, frame, mask = item
+                keypoints, descriptors, histogram = self.describe(frame, mask)
+                if self.gate is not None and not self.gate.accept_keypoints(keypoints):
+                    continue
+
+                if not self._put(self.descriptions, (frame_index, frame, keypoints, descriptors, histogram)):
+                    break
+        finally:
+            self._put(self.descriptions, None)
+
+    def _match(self):
+        try:
+            while True:
+                item = self.descriptions.get()
+                if item is None:
+                    break
+
+                frame_index, frame, keypoints, descriptors, histogram = item
+                self.results.put((frame_index, frame, keypoints, self.match(descriptors, histogram)))
+        finally:
+            self.results.put(None)
+
+    def _drain(self, items):
+        try:
+            while True:
+                items.get_nowait()
+        except queue.Empty:
+            pass
+
+    def matched_frames(self, number_of_frames):
+        """Yields `(frame index, frame, keypoints, match result)` tuples as soon as frames are matched.
+
+        Stops after `number_of_frames` frames (less if the source ends first), or as soon as the caller stops
+        iterating: frames still in the pipeline are then discarded. The frame is the region returned by `segment`, if
+        any.
+        """
+        self.stopping.clear()
+        threads = [threading.Thread(target=self._capture)]
+        threads += [threading.Thread(target=self._describe) for _ in range(self.jobs)]
+        threads += [threading.Thread(target=self._match) for _ in range(self.jobs)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            matched_count = 0
+            running_matchers = self.jobs
+            while running_matchers and matched_count < number_of_frames:
+                result = self.results.get()
+                if result is None:
+                    running_matchers -= 1
+                else:
+                    matched_count += 1
+                    yield result
+        finally:
+            self.stop(threads)
+
+    def stop(self, threads):
+        self.stopping.set()
+        # Unblock the workers still waiting for an item.
+        while any(thread.is_alive() for thread in threads):
+            self._drain(self.frames)
+            self._drain(self.descriptions)
+            for _ in range(self.jobs):
+                try:
+                    self.frames.put_nowait(None)
+                    self.descriptions.put_nowait(None)
+                except queue.Full:
+                    pass
+            time.sleep(0.01)
+
+        self._drain(self.frames)
+        self._drain(self.descriptions)
+        self._drain(self.results)
@@ -0,0 +1,219 @@
+import collections
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
+
+from .feature_database import FeatureDatabase, is_feature_database
+from .feature_extractor import FeatureExtractor
+from .instrumentation import instrumentation
+
+
+def content_key(content, **options):
+    """Key of the results computed from `content` (bytes) with `options`: a hash of both."""
+    digest = hashlib.sha256(content)
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def catalog_version(data_path=None, images_path=None):
+    """Identifies the state of a catalog, to invalidate the results computed against another one.
+
+    This is the version of a feature database, or a hash of the paths, modification times and sizes of the files of
+    the catalog otherwise.
+    """
+    if data_path is not None and is_feature_database(data_path):
+        return FeatureDatabase.open(data_path).version
+
+    paths = [data_path] if data_path is not None else FeatureExtractor.list_images(images_path)
+    return content_key(json.dumps([[path, FeatureExtractor.fingerprint(path)] for path in paths]).encode('utf-8'))
+
+
+def matcher_options(args):
+    """Options the match results depend on, from the parsed `args` of `match.py` or `match-server.py`, to key them.
+
+    The ratio test coefficient, which queries to the server may override, is left out. Results are also keyed by the
+    detector and the catalog, so that several catalogs may share a cache.
+    """
+    return dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
+                surf_threshold=args['surf_threshold'], detector=args['detector'],
+                catalog=args['data'] or args['images'], matcher=args['matcher'],
+                vocabulary_shortlist=args['vocabulary_shortlist'], vocabulary_branching=args['vocabulary_branching'],
+                vocabulary_depth=args['vocabulary_depth'], catalog_index=args['catalog_index'],
+                catalog_neighbours=args['catalog_neighbours'], prefilter_k=args['prefilter_k'],
+                prefilter_min_correlation=args['prefilter_min_correlation'])
+
+
+def create_caches(args, feature_cache_name):
+    """Returns the caches of features and of match results set up by the parsed `args` of `match.py` or
+    `match-server.py` (`--cache-size`, `--cache-ttl`, `--cache-dir`, `--cache-disk-size`), `None` when disabled."""
+    if args['cache_size'] <= 0 and args['cache_dir'] is None:
+        return None, None
+
+    feature_cache = MatchCache(feature_cache_name, args['cache_size'], args['cache_ttl'],
+                               os.path.join(args['cache_dir'], 'features') if args['cache_dir'] is not None else None,
+                               args['cache_disk_size'])
+    # Results are only valid for the catalog they have been computed against.
+    result_cache = MatchCache('match results', args['cache_size'], args['cache_ttl'],
+                              os.path.join(args['cache_dir'], 'results') if args['cache_dir'] is not None else None,
+                              args['cache_disk_size'], catalog_version(args['data'], args['images']))
+    return feature_cache, result_cache
+
+
+class MatchCache:
+    """Least recently used cache of the values (template features, match results...) computed for content keys.
+
+    Holds up to `capacity` values in memory (0 disables the memory tier). Values older than `ttl` seconds, if given,
+    are discarded. With a `directory`, values are also pickled into it, up to `disk_capacity` files, so that they
+    survive restarts: when there are more, the least recently used ones are removed down to 90% of `disk_capacity`,
+    which spares listing the directory on every write. Values stored with another `version` (the
+    version of the feature database results have been computed against) are discarded when read.
+
+    `counters` count hits (in memory and on disk), misses, evictions and discarded values; `name` prefixes them in
+    the instrumentation counters.
+    """
+
+    def __init__(self, name, capacity=256, ttl=None, directory=None, disk_capacity=4096, version=None):
+        self.name = name
+        self.capacity = capacity
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_capacity = disk_capacity
+        self.version = version
+        # Key -> (time the value has been stored, value), least recently used first.
+        self.entries = collections.OrderedDict()
+        # Number of files in `directory`, counted when first written to. Files written by other processes are only
+        # counted when the directory is trimmed.
+        self.disk_count = None
+        self.counters = dict(hits=0, disk_hits=0, misses=0, evictions=0, expired=0, stale=0)
+        # Caches may be shared by the threads of a `MatchServer`.
+        self.lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _count(self, counter):
+        self.counters[counter] += 1
+        instrumentation.count('%s cache %s' % (self.name, counter.replace('_', ' ')))
+
+    def _is_expired(self, stored_time):
+        return self.ttl is not None and time.time() - stored_time > self.ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def get(self, key):
+        """Returns the value stored for `key`, or `None`."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if not self._is_expired(entry[0]):
+                    self.entries.move_to_end(key)
+                    self._count('hits')
+                    return entry[1]
+                del self.entries[key]
+                self._count('expired')
+
+        if self.directory is not None:
+            value = self._read(key)
+            if value is not None:
+                return value
+
+        with self.lock:
+            self._count('misses')
+        return None
+
+    def _read(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as input_file:
+                stored = pickle.load(input_file)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if stored.get('version') != self.version or self._is_expired(stored['time']):
+            with self.lock:
+                self._count('stale' if stored.get('version') != self.version else 'expired')
+            self._remove(path)
+            return None
+
+        # Most recently used, as far as the disk tier is concerned. Another process may have removed it meanwhile.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self.lock:
+            self._count('disk_hits')
+            self._remember(key, stored['time'], stored['value'])
+        return stored['value']
+
+    def _remember(self, key, stored_time, value):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = (stored_time, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self._count('evictions')
+
+    def put(self, key, value):
+        stored_time = time.time()
+        with self.lock:
+            self._remember(key, stored_time, value)
+
+        if self.directory is not None:
+            path = self._path(key)
+            is_new = not os.path.exists(path)
+            # Written to a temporary file first, so that readers never see a partial value.
+            temporary_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+            with open(temporary_path, 'wb') as output_file:
+                pickle.dump(dict(version=self.version, time=stored_time, value=value), output_file,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+
+            with self.lock:
+                if self.disk_count is None:
+                    self.disk_count = len(self._list_directory())
+                elif is_new:
+                    self.disk_count += 1
+                is_full = self.disk_count > self.disk_capacity
+            if is_full:
+                self._trim_directory()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return False
+        with self.lock:
+            if self.disk_count is not None:
+                self.disk_count -= 1
+        return True
+
+    def _list_directory(self):
+        return [os.path.join(self.directory, file_name) for file_name in os.listdir(self.directory)
+                if file_name.endswith('.pickle')]
+
+    def _trim_directory(self):
+        # Files may be removed by other threads or processes while they are listed.
+        stored_paths = []
+        for path in self._list_directory():
+            try:
+                stored_paths.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+
+        with self.lock:
+            self.disk_count = len(stored_paths)
+        stored_paths.sort()
+        kept_count = self.disk_capacity - self.disk_capacity // 10
+        for stored_time, path in stored_paths[:max(0, len(stored_paths) - kept_count)]:
+            if self._remove(path):
+                with self.lock:
+                    self._count('evictions')
+
+    def describe_counters(self):
+        return '{name}: {hits} hits, {disk_hits} disk hits, {misses} misses, {evictions} evictions, {expired} ' \
+               'expired, {stale} stale'.format(name=self.name, **self.counters)
@@ -0,0 +1,242 @@
+import concurrent.futures
+import cv2
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import numpy
+
+from .feature_extractor import compute_histogram, create_detector
+from .instrumentation import instrumentation
+from .match_cache import content_key
+
+# Every message, in both directions, is a JSON header followed by an optional binary payload:
+#
+#   header length (uint32, big endian) | payload length (uint32, big endian) | JSON header | payload
+#
+# Requests hold one of:
+#   {"template": <path of an image readable by the server>}
+#   {"image": true}, the payload being an encoded image (JPEG, PNG...)
+#   {"descriptors": {"dtype": ..., "shape": [n, width]}, "histogram": {"dtype": ..., "shape": [512]}}, the payload
+#     being the descriptors followed by the histogram
+# and optionally "n_matches" (number of results to return, default: all) and "ratio_test_k".
+#
+# Responses hold {"matches": [{"key", "matches", "good_matches", "histogram", "score"}, ...], "time": seconds}, best
+# match first, or {"error": message}.
+_FRAME = struct.Struct('>II')
+
+
+def parse_address(address):
+    # "host:port" is a TCP address, anything else the path of a UNIX socket.
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+def _receive_exactly(connection, size):
+    chunks = []
+    while size > 0:
+        chunk = connection.recv(min(size, 1 << 20))
+        if not chunk:
+            raise EOFError('Connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def send_message(connection, header, payload=b''):
+    encoded_header = json.dumps(header).encode('utf-8')
+    connection.sendall(_FRAME.pack(len(encoded_header), len(payload)) + encoded_header)
+    if payload:
+        connection.sendall(payload)
+
+
+def receive_message(connection):
+    header_length, payload_length = _FRAME.unpack(_receive_exactly(connection, _FRAME.size))
+    header = json.loads(_receive_exactly(connection, header_length).decode('utf-8'))
+    return header, _receive_exactly(connection, payload_length)
+
+
+def query_server(address, request, payload=b''):
+    """Sends one request to a `MatchServer` and returns its response header."""
+    family, socket_address = parse_address(address)
+    connection = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_address)
+        send_message(connection, request, payload)
+        response, _ = receive_message(connection)
+    finally:
+        connection.close()
+
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+
+    return response
+
+
+def decode_image(image_content):
+    image = cv2.imdecode(numpy.frombuffer(image_content, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Unable to decode image')
+    return image
+
+
+class MatchService:
+    """Matches query images against a catalog loaded once, from any number of threads.
+
+    With a `feature_cache` and a `result_cache` (see `MatchCache`), the features and the results of the queries are
+    cached by content, the results also by the detector options and `matcher_options` (a dictionary of the options the
+    catalog matcher has been built with).
+    """
+
+    def __init__(self, image_descriptions, catalog_matcher, detector_type, detector_options, ratio_test_coefficient,
+                 feature_cache=None, result_cache=None, matcher_options=None):
+        self.image_descriptions = image_descriptions
+        self.catalog_matcher = catalog_matcher
+        self.detector_type = detector_type
+        self.detector_options = detector_options
+        self.ratio_test_coefficient = ratio_test_coefficient
+        self.feature_cache = feature_cache
+        self.result_cache = result_cache
+        # The catalog has been described with the same detector options as the queries: they change the results too.
+        self.matcher_options = dict(detector_options, detector=detector_type)
+        self.matcher_options.update(matcher_options or {})
+        # OpenCV detectors are not meant to be shared between threads, every thread gets its own.
+        self.local = threading.local()
+
+    def get_detector(self):
+        if not hasattr(self.local, 'detector'):
+            self.local.detector = create_detector(self.detector_type, self.detector_options)
+        return self.local.detector
+
+    def describe(self, image, mask=None):
+        # Only the pixels selected by `mask` (if any) are described.
+        with instrumentation.stage('describe.detect'):
+            gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            (keypoints, descriptors) = self.get_detector().detectAndCompute(gray_image, mask)
+        with instrumentation.stage('describe.histogram'):
+            histogram = compute_histogram(image, mask)
+        return keypoints, descriptors, histogram
+
+    def match(self, descriptors, histogram, ratio_test_coefficient=None):
+        return self.catalog_matcher.match(descriptors, histogram, ratio_test_coefficient or self.ratio_test_coefficient)
+
+    def describe_cached(self, image_content):
+        """Same as `describe` for an encoded image, without the keypoints, from the feature cache if possible."""
+        feature_key = content_key(image_content, detector=self.detector_type, **self.detector_options)
+        features = self.feature_cache.get(feature_key)
+        if features is not None:
+            return features
+
+        keypoints, descriptors, histogram = self.describe(decode_image(image_content))
+        self.feature_cache.put(feature_key, (descriptors, histogram))
+
+        return descriptors, histogram
+
+    def handle(self, request, payload):
+        start = time.time()
+
+        if 'template' in request and (self.feature_cache is not None or self.result_cache is not None):
+            # Cached by content, like encoded images.
+            with open(request['template'], 'rb') as template_file:
+                payload = template_file.read()
+            request = dict(request, image=True)
+            del request['template']
+
+        result_key = None
+        if self.result_cache is not None:
+            # Descriptors are keyed by their format as well as their bytes.
+            result_key = content_key(payload, descriptors=request.get('descriptors'),
+                                     histogram=request.get('histogram'), n_matches=request.get('n_matches'),
+                                     ratio_test_k=request.get('ratio_test_k') or self.ratio_test_coefficient,
+                                     **self.matcher_options)
+            matches = self.result_cache.get(result_key)
+            if matches is not None:
+                return dict(matches=matches, time=time.time() - start)
+
+        if 'template' in request:
+            image = cv2.imread(request['template'])
+            if image is None:
+                raise ValueError('Unable to read image "{}"'.format(request['template']))
+            keypoints, descriptors, histogram = self.describe(image)
+        elif 'image' in request and self.feature_cache is not None:
+            descriptors, histogram = self.describe_cached(payload)
+        elif 'image' in request:
+            keypoints, descriptors, histogram = self.describe(decode_image(payload))
+        elif 'descriptors' in request:
+            descriptors_format, histogram_format = request['descriptors'], request['histogram']
+            descriptors_size = int(numpy.prod(descriptors_format['shape'])) * \
+                numpy.dtype(descriptors_format['dtype']).itemsize
+            descriptors = numpy.frombuffer(payload[:descriptors_size], dtype=descriptors_format['dtype']).reshape(
+                descriptors_format['shape'])
+            histogram = numpy.frombuffer(payload[descriptors_size:], dtype=histogram_format['dtype']).reshape(
+                histogram_format['shape'])
+        else:
+            raise ValueError('Request has no "template", "image" or "descriptors"')
+
+        match_result = self.match(descriptors, histogram, request.get('ratio_test_k'))
+
+        matches = match_result.top(self.image_descriptions, request.get('n_matches'))
+        if result_key is not None:
+            self.result_cache.put(result_key, matches)
+
+        return dict(matches=matches, time=time.time() - start)
+
+
+class _MatchRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # A connection may send any number of requests, one after the other.
+        while True:
+            try:
+                request, payload = receive_message(self.request)
+            except EOFError:
+                return
+
+            try:
+                response = self.server.service.handle(request, payload)
+            except Exception as exception:
+                response = dict(error=str(exception))
+
+            send_message(self.request, response)
+
+
+class MatchServer(socketserver.TCPServer):
+    """Serves a `MatchService` over a UNIX or TCP socket, handling connections in a pool of `jobs` threads.
+
+    Matching mostly runs in OpenCV, which releases the GIL: threads are enough to use several cores.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, address, service, jobs):
+        self.address_family, socket_address = parse_address(address)
+        if self.address_family == socket.AF_UNIX and os.path.exists(socket_address):
+            # Left behind by a previous server.
+            os.remove(socket_address)
+
+        self.service = service
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        socketserver.TCPServer.__init__(self, socket_address, _MatchRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.executor.shutdown(wait=False)
+        if self.address_family == socket.AF_UNIX and os.path.exists(self.server_address):
+            os.remove(self.server_address)
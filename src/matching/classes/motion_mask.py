@@ -0,0 +1,44 @@
+import cv2
+
+from .instrumentation import instrumentation
+from .segmentation import clean_mask
+
+
+def crop_to_mask(image, mask):
+    """Crops `image` and `mask` to the bounding box of the pixels selected by `mask` (views, nothing is copied)."""
+    if mask is None:
+        return image, None
+
+    x, y, width, height = cv2.boundingRect(mask)
+    return image[y:y + height, x:x + width], mask[y:y + height, x:x + width]
+
+
+class MotionMask:
+    """Segments the object moving in front of the camera, one frame after the other.
+
+    Same steps as `src/main.py` with `--use-contour`: KNN background subtraction, then the mask is cleaned up by
+    `clean_mask` and replaced by the convex hulls of its contours larger than `min_size` pixels.
+    """
+
+    def __init__(self, blur=15, min_size=100, remove_shadows=False):
+        self.blur = blur
+        self.min_size = min_size
+        self.remove_shadows = remove_shadows
+        self.background_subtractor = cv2.createBackgroundSubtractorKNN()
+
+    def apply(self, frame):
+        """Returns the mask of the moving object of `frame`, or `None` if nothing large enough moves."""
+        with instrumentation.stage('background.subtract'):
+            mask = self.background_subtractor.apply(frame)
+
+        with instrumentation.stage('background.cleanup'):
+            score, mask = clean_mask(mask, self.blur, self.min_size, self.remove_shadows, use_contour=True)
+
+        return mask if score > 0 else None
+
+    def segment(self, frame):
+        """Returns the region of `frame` around its moving object and the mask of the object within it.
+
+        The whole frame and no mask are returned if nothing moves.
+        """
+        return crop_to_mask(frame, self.apply(frame))
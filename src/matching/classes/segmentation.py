@@ -0,0 +1,103 @@
+import logging
+
+import cv2
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def clean_mask(mask, blur=15, min_size=100, remove_shadows=False, fill_holes=False, use_contour=False, surface=None,
+               contours_path=None):
+    """Cleans up a background subtraction mask, as done by `src/main.py` for every frame.
+
+    The mask is blurred to get back some of the missing pixels and thresholded, then optionally its holes are filled
+    (`fill_holes`) and it is replaced by the convex hulls of its contours larger than `min_size` pixels
+    (`use_contour`, written to `contours_path` if given). `surface` is the number of pixels of the frame.
+
+    Returns the score of the mask (its number of pixels) and the mask.
+    """
+    height, width = mask.shape[:2]
+    if surface is None:
+        surface = height * width
+
+    if remove_shadows:
+        mask = cv2.bitwise_and(mask, 255)
+
+    # Smoothen a bit the mask to get back some of the missing pixels
+    if blur > 0:
+        mask = cv2.blur(mask, (blur, blur))
+
+    ret, mask = cv2.threshold(mask, 1, 255, cv2.THRESH_BINARY)
+
+    corners = [[0, 0], [height - 1, 0], [0, width - 1], [height - 1, width - 1]]
+
+    score = cv2.countNonZero(mask)
+    log.debug("Starting with a score of %d.", score)
+    if fill_holes and score != surface:
+        # Attempt to fill any holes.
+        # At this stage, often, we have a mask surrounded by black and containing holes.
+        # (this is not always the case -  sometimes, the mask is a cloud of points).
+        positive = mask.copy()
+        fill_mask = numpy.zeros((height + 2, width + 2), numpy.uint8)
+        found = False
+        for y, x in corners:
+            if positive[y, x] == 0:
+                cv2.floodFill(positive, fill_mask, (x, y), 255)
+                found = True
+                break
+
+        if found:
+            filled = cv2.bitwise_or(mask, cv2.bitwise_not(positive))
+
+            # Check if we haven't filled too many things, in which case
+            # our fill operation actually decreased the quality of the
+            # image.
+            filled_score = cv2.countNonZero(filled)
+            if filled_score < surface * .9:
+                has_empty_corners = False
+                for y, x in corners:
+                    if filled[y, x] == 0:
+                        has_empty_corners = True
+                        break
+                if has_empty_corners:
+                    # Apparently, we have managed to remove holes, without filling
+                    # the entire frame.
+                    score = filled_score
+                    mask = filled
+                    log.debug("Improved to a score of %d", score)
+
+    bw_mask = mask
+
+    if use_contour:
+        # OpenCV 3 also returns the image, OpenCV 4 does not.
+        contours = cv2.findContours(bw_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+
+        # FIXME: We could remove small contours (here or later)
+        bw_mask = numpy.zeros((height, width), numpy.uint8)
+        for cnt in contours:
+            if cv2.contourArea(cnt) > min_size or 0:
+                hull = cv2.convexHull(cnt)
+                cv2.fillPoly(bw_mask, [hull], 255, 8)
+
+        if contours_path:
+            print("Writing contours to %s." % contours_path)
+            cv2.imwrite(contours_path, bw_mask)
+
+        log.debug("contours: %d, score: %d", len(contours), score)
+
+    return cv2.countNonZero(bw_mask), bw_mask
+
+
+def remove_small_components(bw_mask, min_size, images):
+    """Blanks in `images` the connected components of `bw_mask` with fewer than `min_size` pixels.
+
+    Returns the number of components removed.
+    """
+    number, components, stats, centroids = cv2.connectedComponentsWithStats(bw_mask)
+    # Whether to keep each label, looked up for all pixels at once.
+    keep = stats[:, cv2.CC_STAT_AREA] >= min_size
+    kill_list = ~keep[components]
+    for image in images:
+        image[kill_list] = 0
+
+    return number - numpy.count_nonzero(keep)
@@ -0,0 +1,31 @@
+import numpy
+
+
+class SequentialDecision:
+    """Accumulates the scores of every image over successive frames, until one of them clearly leads.
+
+    The decision is taken once at least `min_frames` frames have been added and the relative margin of the leader
+    over the runner-up, `1 - runner-up evidence / leader evidence`, reaches `margin`.
+    """
+
+    def __init__(self, image_count, margin, min_frames=1):
+        self.margin = margin
+        self.min_frames = min_frames
+        self.evidence = numpy.zeros(image_count)
+        self.frame_count = 0
+
+    def add(self, match_result):
+        self.evidence += match_result.scores
+        self.frame_count += 1
+
+    def leader(self):
+        return int(numpy.argmax(self.evidence))
+
+    def leader_margin(self):
+        if len(self.evidence) < 2:
+            return 1.
+        runner_up, leader = numpy.partition(self.evidence, -2)[-2:]
+        return 1. - runner_up / leader if leader > 0 else 0.
+
+    def is_decided(self):
+        return self.frame_count >= self.min_frames and self.leader_margin() >= self.margin
@@ -0,0 +1,269 @@
+import collections
+import cv2
+import json
+import os
+
+import numpy
+
+from .instrumentation import instrumentation
+
+# Version of the files written by `VocabularyIndex.save`, bump it whenever their content changes.
+VOCABULARY_FORMAT_VERSION = 2
+
+
+def get_vocabulary_path(database_path):
+    # The vocabulary index of a feature database is stored next to it.
+    return database_path + '.vocabulary'
+
+
+def _nearest(descriptors, centers, norm):
+    distance_type = cv2.CV_32S if norm == cv2.NORM_HAMMING else cv2.CV_32F
+    distances, indices = cv2.batchDistance(descriptors, centers, distance_type, normType=norm, K=1)
+    return indices.ravel()
+
+
+def _cluster(descriptors, k, norm, iterations, random_state):
+    """Splits `descriptors` into (at most) `k` clusters, returns their centers and the label of every descriptor.
+
+    Binary descriptors are clustered with k-majority (every bit of a center is the majority bit of its cluster, with
+    Hamming distances), the others with k-means.
+    """
+    if len(descriptors) <= k:
+        return descriptors.copy(), numpy.arange(len(descriptors))
+
+    centers = descriptors[random_state.choice(len(descriptors), k, replace=False)].copy()
+    labels = None
+    for _ in range(iterations):
+        new_labels = _nearest(descriptors, centers, norm)
+        if labels is not None and numpy.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+
+        for cluster in range(k):
+            members = descriptors[labels == cluster]
+            # Empty clusters keep their center.
+            if len(members) == 0:
+                continue
+            if norm == cv2.NORM_HAMMING:
+                centers[cluster] = numpy.packbits(numpy.unpackbits(members, axis=1).mean(axis=0) > .5)
+            else:
+                centers[cluster] = members.mean(axis=0)
+
+    return centers, labels
+
+
+class VocabularyTree:
+    """Hierarchical vocabulary of visual words (a vocabulary tree): every node splits its descriptors into `branching`
+    clusters, down to `depth` levels. The leaves are the words.
+
+    Nodes are stored in arrays: `centers[node]`, `children[node]` (-1 when missing) and `node_words[node]` (the word of
+    a leaf, -1 for the other nodes). Node 0 is the root.
+    """
+
+    def __init__(self, centers, children, node_words, norm, depth):
+        self.centers = centers
+        self.children = children
+        self.node_words = node_words
+        self.norm = norm
+        self.depth = depth
+
+    @property
+    def branching(self):
+        return self.children.shape[1]
+
+    @property
+    def word_count(self):
+        return int(self.node_words.max()) + 1 if len(self.node_words) else 0
+
+    @staticmethod
+    def train(descriptors, norm, branching=10, depth=4, iterations=10, seed=0):
+        random_state = numpy.random.RandomState(seed)
+        centers = [numpy.zeros(descriptors.shape[1], dtype=descriptors.dtype)]
+        children = [[-1] * branching]
+        node_words = [-1]
+        word_count = 0
+
+        # Breadth first: (node, descriptors reaching it, level).
+        pending = collections.deque([(0, descriptors, 0)])
+        while pending:
+            node, node_descriptors, level = pending.popleft()
+            if level == depth or len(node_descriptors) <= 1:
+                node_words[node] = word_count
+                word_count += 1
+                continue
+
+            node_centers, labels = _cluster(node_descriptors, branching, norm, iterations, random_state)
+            for cluster, center in enumerate(node_centers):
+                child = len(centers)
+                centers.append(center)
+                children.append([-1] * branching)
+                node_words.append(-1)
+                children[node][cluster] = child
+                pending.append((child, node_descriptors[labels == cluster], level + 1))
+
+        return VocabularyTree(numpy.array(centers, dtype=descriptors.dtype), numpy.array(children, dtype=numpy.int32),
+                              numpy.array(node_words, dtype=numpy.int32), norm, depth)
+
+    def quantize(self, descriptors):
+        """Returns the word of every descriptor."""
+        nodes = numpy.zeros(len(descriptors), dtype=numpy.int32)
+        while True:
+            internal = self.node_words[nodes] < 0
+            if not internal.any():
+                return self.node_words[nodes]
+
+            # Descend one level, node by node.
+            for node in numpy.unique(nodes[internal]):
+                selected = numpy.flatnonzero(nodes == node)
+                node_children = self.children[node][self.children[node] >= 0]
+                nodes[selected] = node_children[_nearest(descriptors[selected], self.centers[node_children],
+                                                         self.norm)]
+
+
+class VocabularyIndex:
+    """Inverted file over the visual words of the images of a catalog, to retrieve the images most likely to match.
+
+    Images and queries are described by their TF-IDF weighted, L1 normalized, word histograms and ranked by their L1
+    similarity, computed from the inverted lists of the query words only: the cost of a query depends on the number
+    of images sharing its words rather than on the size of the catalog.
+    """
+
+    def __init__(self, tree, idf, word_offsets, posting_images, posting_weights, image_count):
+        # Where the index comes from: 'built', 'loaded' from the files written by `save`, or 'rebuilt' because these
+        # files do not match the database any more (see `open`).
+        self.index_source = 'built'
+        self.tree = tree
+        self.idf = idf
+        # The postings of word `w` are `posting_images[word_offsets[w]:word_offsets[w + 1]]`, with their weights.
+        self.word_offsets = word_offsets
+        self.posting_images = posting_images
+        self.posting_weights = posting_weights
+        self.image_count = image_count
+
+    def __len__(self):
+        return self.image_count
+
+    @staticmethod
+    def build(image_descriptions, norm, branching=10, depth=4):
+        blocks = [image_description.descriptors for image_description in image_descriptions
+                  if image_description.descriptors is not None]
+        counts = [0 if image_description.descriptors is None else len(image_description.descriptors)
+                  for image_description in image_descriptions]
+        descriptors = numpy.ascontiguousarray(numpy.concatenate(blocks)) if blocks else \
+            numpy.zeros((0, 32), dtype=numpy.uint8)
+
+        with instrumentation.stage('vocabulary.train'):
+            tree = VocabularyTree.train(descriptors, norm, branching, depth)
+
+        with instrumentation.stage('vocabulary.index'):
+            words = tree.quantize(descriptors)
+            images = numpy.repeat(numpy.arange(len(image_descriptions), dtype=numpy.int32), counts)
+
+            # Term frequencies of every (word, image) pair, sorted by word then image.
+            pairs, frequencies = numpy.unique(words.astype(numpy.int64) * len(image_descriptions) + images,
+                                              return_counts=True)
+            pair_words = pairs // len(image_descriptions)
+            pair_images = (pairs % len(image_descriptions)).astype(numpy.int32)
+
+            document_frequencies = numpy.bincount(pair_words, minlength=tree.word_count)
+            idf = numpy.log(len(image_descriptions) / numpy.maximum(document_frequencies, 1)).astype(numpy.float32)
+
+            weights = frequencies * idf[pair_words]
+            norms = numpy.bincount(pair_images, weights=weights, minlength=len(image_descriptions))
+            weights = numpy.divide(weights, norms[pair_images], out=numpy.zeros_like(weights),
+                                   where=norms[pair_images] > 0).astype(numpy.float32)
+
+            word_offsets = numpy.concatenate(([0], numpy.cumsum(document_frequencies))).astype(numpy.int64)
+
+        return VocabularyIndex(tree, idf, word_offsets, pair_images, weights, len(image_descriptions))
+
+    def score(self, descriptors):
+        """Similarity, between 0 and 1, of every image of the catalog with a query holding `descriptors`."""
+        scores = numpy.zeros(self.image_count)
+        if descriptors is None or len(descriptors) == 0:
+            return scores
+
+        words, frequencies = numpy.unique(self.tree.quantize(descriptors), return_counts=True)
+        query_weights = frequencies * self.idf[words]
+        if query_weights.sum() <= 0:
+            return scores
+        query_weights /= query_weights.sum()
+
+        starts = self.word_offsets[words]
+        lengths = self.word_offsets[words + 1] - starts
+        # Positions of the postings of all the query words, in one array.
+        positions = numpy.arange(lengths.sum()) - numpy.repeat(numpy.cumsum(lengths) - lengths - starts, lengths)
+
+        image_weights = self.posting_weights[positions]
+        repeated_query_weights = numpy.repeat(query_weights, lengths)
+        # ||q - d||_1 = 2 + sum over the shared words of (|q_w - d_w| - q_w - d_w), for L1 normalized vectors.
+        shared = numpy.abs(repeated_query_weights - image_weights) - repeated_query_weights - image_weights
+        scores -= .5 * numpy.bincount(self.posting_images[positions], weights=shared, minlength=self.image_count)
+
+        return scores
+
+    def shortlist(self, descriptors, size, candidates=None):
+        """Mask of the `size` images most similar to the query, among the `candidates` ones if given."""
+        scores = self.score(descriptors)
+        if candidates is not None:
+            scores = numpy.where(candidates, scores, -numpy.inf)
+
+        shortlist = numpy.zeros(self.image_count, dtype=bool)
+        # Ties kept in catalog order.
+        order = numpy.argsort(-scores, kind='stable')[:size]
+        shortlist[order[numpy.isfinite(scores[order])]] = True
+
+        return shortlist
+
+    @staticmethod
+    def open(image_descriptions, norm, database=None, branching=10, depth=4):
+        """Loads the vocabulary index stored next to `database`, or builds it when there is none, it is out of
+        date or it has another `branching` or `depth`."""
+        vocabulary_index = VocabularyIndex.load(database, norm, branching, depth) if database is not None else None
+        if vocabulary_index is not None:
+            vocabulary_index.index_source = 'loaded'
+            return vocabulary_index
+
+        vocabulary_index = VocabularyIndex.build(image_descriptions, norm, branching, depth)
+        if database is not None and os.path.exists(get_vocabulary_path(database.path) + '.json'):
+            vocabulary_index.index_source = 'rebuilt'
+        return vocabulary_index
+
+    def describe_index(self, database):
+        return dict(format=VOCABULARY_FORMAT_VERSION, database=database.version, norm=int(self.tree.norm),
+                    words=self.tree.word_count, branching=self.tree.branching, depth=self.tree.depth)
+
+    def save(self, database):
+        """Writes the vocabulary and the inverted file next to `database`, with the options they have been built
+        with."""
+        vocabulary_path = get_vocabulary_path(database.path)
+        with open(vocabulary_path + '.npz', 'wb') as output_file:
+            numpy.savez(output_file, centers=self.tree.centers, children=self.tree.children,
+                        node_words=self.tree.node_words, idf=self.idf, word_offsets=self.word_offsets,
+                        posting_images=self.posting_images, posting_weights=self.posting_weights)
+
+        with open(vocabulary_path + '.json', 'w') as output_file:
+            json.dump(self.describe_index(database), output_file)
+
+    @staticmethod
+    def load(database, norm, branching, depth):
+        """Loads the vocabulary index saved next to `database`.
+
+        Returns `None` when there is none, or when it has been saved for another version of the database or with
+        another `branching` or `depth`.
+        """
+        vocabulary_path = get_vocabulary_path(database.path)
+        if not os.path.exists(vocabulary_path + '.json') or not os.path.exists(vocabulary_path + '.npz'):
+            return None
+
+        with open(vocabulary_path + '.json', 'r') as input_file:
+            description = json.load(input_file)
+        if description.get('format') != VOCABULARY_FORMAT_VERSION or \
+                description.get('database') != database.version or description.get('norm') != norm or \
+                description.get('branching') != branching or description.get('depth') != depth:
+            return None
+
+        with numpy.load(vocabulary_path + '.npz') as arrays:
+            tree = VocabularyTree(arrays['centers'], arrays['children'], arrays['node_words'], norm, depth)
+            return VocabularyIndex(tree, arrays['idf'], arrays['word_offsets'], arrays['posting_images'],
+                                   arrays['posting_weights'], len(database))
@@ -1,13 +1,21 @@
 import argparse
 import datetime
+import multiprocessing
+import sys
+import time
 
+from classes.catalog_index import CatalogIndex, get_norm
+from classes.descriptor_pruning import DescriptorPruner
+from classes.feature_database import FeatureDatabase
 from classes.feature_extractor import FeatureExtractor
+from classes.instrumentation import instrumentation
+from classes.vocabulary_index import VocabularyIndex
 
 parser = argparse.ArgumentParser(description='Finds, extracts and saves the best features of the provided image set.')
 parser.add_argument('-i', '--images', required=True,
                     help='Path to the folder with the images we would like to extract features for.')
 parser.add_argument('-o', '--output', required=True,
-                    help='Path to the file that will store all extracted features (in JSON format).')
+                    help='Path to the file that will store all extracted features (binary feature database).')
 parser.add_argument('--detector', help='Feature detector to use (default: orb)', choices=['orb', 'akaze', 'surf'],
                     default='orb')
 parser.add_argument('--orb-n-features', help='Number of features to extract used in ORB detector (default: 2000)',
@@ -17,26 +25,133 @@ parser.add_argument('--akaze-n-channels', help='Number of channels used in AKAZE
 parser.add_argument('--surf-threshold',
                     help='Threshold for hessian keypoint detector used in SURF detector (default: 1000)',
                     default=1000, type=int)
-parser.add_argument('--verbose', help='Increase output verbosity', action='store_true')
+parser.add_argument('-j', '--jobs', help='Number of worker processes extracting features (default: number of CPUs)',
+                    default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--incremental',
+                    help='Only extract features of the images that were added or changed since the output file was '
+                         'written, drop the images that were removed (with --prune, all images are extracted '
+                         'again)', action='store_true')
+parser.add_argument('--build-index',
+                    help='Also build the FLANN index of the features and store it next to the output file, for the '
+                         'matchers to load with --matcher=flann --catalog-index', action='store_true')
+parser.add_argument('--build-vocabulary',
+                    help='Also train a visual vocabulary on the features, index the images with it and store it next '
+                         'to the output file, for the matchers to load with --matcher=vocabulary', action='store_true')
+parser.add_argument('--vocabulary-branching',
+                    help='Number of children of every node of the vocabulary tree (default: 10)', default=10, type=int)
+parser.add_argument('--vocabulary-depth',
+                    help='Depth of the vocabulary tree, which has up to branching^depth words (default: 4)', default=4,
+                    type=int)
+parser.add_argument('--prune',
+                    help='Drop the descriptors that are ambiguous across the catalog or redundant within an image, and '
+                         'keep only the --prune-budget most distinctive ones of every image', action='store_true')
+parser.add_argument('--prune-budget', help='With --prune, maximum number of descriptors kept per image (default: 500, '
+                                           '0 keeps all)', default=500, type=int)
+parser.add_argument('--prune-ambiguity-distance',
+                    help='With --prune, drop the descriptors that have a descriptor of another image within this '
+                         'distance (default: 30 bits for ORB and AKAZE, 0 (disabled) for SURF)', default=None,
+                    type=float)
+parser.add_argument('--prune-redundancy-distance',
+                    help='With --prune, drop the descriptors within this distance of a descriptor kept for the same '
+                         'image (default: 20 bits for ORB and AKAZE, 0 (disabled) for SURF)', default=None, type=float)
+parser.add_argument('--verbose', help='Increase output verbosity, time every processing stage and print a summary '
+                                      'of them at the end', action='store_true')
+parser.add_argument('--profile', help='Write the stage timings and counters as JSON to this file (default: none)',
+                    default=None)
+parser.add_argument('--trace', help='Write every timed stage as a Chrome trace (chrome://tracing) to this file '
+                                    '(default: none)', default=None)
 args = vars(parser.parse_args())
 
-verbose = args["verbose"]
-output_file_name = args["output"]
 
-if verbose:
-    print('Going to write features to a file "{}": {:%H:%M:%S.%f}'.format(output_file_name, datetime.datetime.now()))
+def main():
+    verbose = args["verbose"]
+    output_file_name = args["output"]
 
-feature_extractor = FeatureExtractor(verbose)
+    if verbose or args["profile"] is not None or args["trace"] is not None:
+        instrumentation.enable(tracing=args["trace"] is not None)
 
-options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
-               surf_threshold=args['surf_threshold'])
+    if verbose:
+        print('Going to write features to a file "{}": {:%H:%M:%S.%f}'.format(output_file_name,
+                                                                               datetime.datetime.now()))
 
-extracted_features = feature_extractor.extract(args["images"], args["detector"], options)
+    feature_extractor = FeatureExtractor(verbose, args['jobs'])
 
-if verbose:
-    print('All features have been extracted, serializing...: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+    options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
+                   surf_threshold=args['surf_threshold'])
 
-feature_extractor.serialize(extracted_features, output_file_name)
+    pruner = None
+    if args['prune']:
+        # Distances are numbers of differing bits for binary descriptors, euclidean ones for SURF.
+        ambiguity_distance, redundancy_distance = (0, 0) if args['detector'] == 'surf' else (30, 20)
+        if args['prune_ambiguity_distance'] is not None:
+            ambiguity_distance = args['prune_ambiguity_distance']
+        if args['prune_redundancy_distance'] is not None:
+            redundancy_distance = args['prune_redundancy_distance']
+        pruner = DescriptorPruner(get_norm(args['detector']), args['prune_budget'], ambiguity_distance,
+                                  redundancy_distance)
+    pruning = pruner.describe_options() if pruner is not None else None
 
-if verbose:
-    print('Done.')
+    incremental = args['incremental']
+    if incremental and pruner is not None and pruner.is_enabled():
+        # Which descriptors are ambiguous or the most distinctive depends on the whole catalog, and the database only
+        # holds the descriptors kept by the previous run: pruning them again would drift from a full extraction.
+        print('\033[93mWarning: --incremental cannot reuse pruned descriptions, extracting all images again.\033[0m')
+        incremental = False
+
+    if incremental:
+        extracted_features, fingerprints = feature_extractor.extract_incremental(args["images"], args["detector"],
+                                                                                 options, output_file_name, pruning)
+    else:
+        image_paths = feature_extractor.list_images(args["images"])
+        fingerprints = dict((image_path, feature_extractor.fingerprint(image_path)) for image_path in image_paths)
+        extracted_features = feature_extractor.extract_images(image_paths, args["detector"], options)
+
+    if pruner is not None and pruner.is_enabled():
+        prune_start = time.time()
+        descriptor_count = sum(0 if image_description.descriptors is None else len(image_description.descriptors)
+                               for image_description in extracted_features)
+
+        extracted_features = pruner.prune(extracted_features)
+
+        print("\033[94mDescriptors have been pruned from %d to %d (%.1f%%) in %s seconds (%s).\033[0m" % (
+            descriptor_count, pruner.counters['kept'], 100. * pruner.counters['kept'] / max(descriptor_count, 1),
+            time.time() - prune_start, pruner.describe_counters()))
+
+    if verbose:
+        print('All features have been extracted, serializing...: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+
+    feature_extractor.serialize(extracted_features, output_file_name,
+                                dict(detector=args['detector'], options=options, pruning=pruning,
+                                     fingerprints=fingerprints))
+
+    if args['build_index']:
+        if verbose:
+            print('Building FLANN index: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+
+        with instrumentation.stage('index.build'):
+            database = FeatureDatabase.open(output_file_name)
+            catalog_index = CatalogIndex(database.image_descriptions(), get_norm(args['detector']), 'flann',
+                                         database=database)
+            catalog_index.save(database)
+
+    if args['build_vocabulary']:
+        if verbose:
+            print('Building vocabulary index: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+
+        vocabulary_start = time.time()
+        database = FeatureDatabase.open(output_file_name)
+        vocabulary_index = VocabularyIndex.build(database.image_descriptions(), get_norm(args['detector']),
+                                                 args['vocabulary_branching'], args['vocabulary_depth'])
+        vocabulary_index.save(database)
+
+        print("\033[94mVocabulary of %d words has been built in %s seconds.\033[0m" % (
+            vocabulary_index.tree.word_count, time.time() - vocabulary_start))
+
+    if verbose:
+        print('Done.')
+
+    instrumentation.report(verbose, args["profile"], args["trace"])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
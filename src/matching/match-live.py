@@ -1,11 +1,19 @@
 import argparse
 import cv2
-import datetime
+import multiprocessing
 import os
 import sys
 import time
 
-from classes.feature_extractor import FeatureExtractor
+from classes.catalog_index import get_norm, load_or_build
+from classes.catalog_matcher import CatalogMatcher
+from classes.feature_extractor import FeatureExtractor, compute_histogram, create_detector
+from classes.frame_gate import FrameGate
+from classes.instrumentation import instrumentation
+from classes.live_pipeline import FramePipeline
+from classes.match_service import MatchService
+from classes.motion_mask import MotionMask
+from classes.sequential_decision import SequentialDecision
 
 is_raspberry_pi = os.uname()[1] == 'raspberrypi2'
 
@@ -13,22 +21,51 @@ if is_raspberry_pi:
     import RPi.GPIO as GPIO
 
 GPIO_NUMBER = 17
-FLANN_INDEX_KDTREE = 1
-FLANN_INDEX_LSH = 6
 
 parser = argparse.ArgumentParser(
     description='Finds the best match for the input image among the images in the provided folder.')
 parser.add_argument('-s', '--source', help='Video to use (default: built-in cam)', default=0)
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument('-i', '--images', help='Path to the folder with the images we would like to match')
-group.add_argument('-d', '--data', help='Path to the folder with the images we would like to match')
+group.add_argument('-d', '--data', help='Path to the feature database created by extract_features.py')
 parser.add_argument('--detector', help='Feature detector to use (default: orb)', choices=['orb', 'akaze', 'surf'],
                     default='orb')
-parser.add_argument('--matcher', help='Matcher to use (default: brute-force)', choices=['brute-force', 'flann'],
-                    default='brute-force')
+parser.add_argument('--matcher',
+                    help='Matcher to use, "vocabulary" matches descriptors (by brute-force) only against the images '
+                         'that a visual vocabulary index ranks first (default: brute-force)',
+                    choices=['brute-force', 'flann', 'vocabulary'], default='brute-force')
+parser.add_argument('--vocabulary-shortlist',
+                    help='Number of images matched with --matcher=vocabulary (default: 10)', default=10, type=int)
+parser.add_argument('--vocabulary-branching',
+                    help='Number of children of every node of the vocabulary tree, the one stored next to the feature '
+                         'database by extract_features.py --build-vocabulary is rebuilt if it differs (default: 10)',
+                    default=10, type=int)
+parser.add_argument('--vocabulary-depth',
+                    help='Depth of the vocabulary tree, the one stored next to the feature database is rebuilt if it '
+                         'differs (default: 4)', default=4, type=int)
+parser.add_argument('--catalog-index',
+                    help='Search the descriptors of all images at once with a single index (with --matcher=flann, the '
+                         'index stored next to the feature database by extract_features.py --build-index is used)',
+                    action='store_true')
+parser.add_argument('--catalog-neighbours',
+                    help='Number of neighbours retrieved across the catalog with --catalog-index (default: 8)',
+                    default=8, type=int)
+parser.add_argument('--prefilter-k',
+                    help='Only match descriptors against the K images whose colour histogram is the closest to the '
+                         'template\'s (default: 0, match all images)', default=0, type=int)
+parser.add_argument('--prefilter-min-correlation',
+                    help='Only match descriptors against the images whose colour histogram correlation with the '
+                         'template is at least this value (default: none)', default=None, type=float)
 parser.add_argument('--n-matches', help='Number of best matches to display  (default: 3)', default=3, type=int)
 parser.add_argument('--ratio-test-k', help='Ratio test coefficient (default: 0.75)', default=0.75, type=float)
 parser.add_argument('--n-frames', help='How many frames to capture for matching (default: 100)', default=100, type=int)
+parser.add_argument('--decision-margin',
+                    help='Stop capturing as soon as the best image leads the second one by this relative margin of '
+                         'their scores accumulated over the frames, e.g. 0.3 (default: none, use all frames)',
+                    default=None, type=float)
+parser.add_argument('--decision-min-frames',
+                    help='Number of frames to match before taking a decision with --decision-margin (default: 3)',
+                    default=3, type=int)
 parser.add_argument('--orb-n-features', help='Number of features to extract used in ORB detector (default: 2000)',
                     default=2000, type=int)
 parser.add_argument('--akaze-n-channels', help='Number of channels used in AKAZE detector (default: 3)',
@@ -36,43 +73,39 @@ parser.add_argument('--akaze-n-channels', help='Number of channels used in AKAZE
 parser.add_argument('--surf-threshold',
                     help='Threshold for hessian keypoint detector used in SURF detector (default: 1000)',
                     default=1000, type=int)
-parser.add_argument('--verbose', help='Increase output verbosity', action='store_true')
+parser.add_argument('--motion-mask',
+                    help='Only extract features from the object moving in front of the camera, isolated with '
+                         'background subtraction as in src/main.py', action='store_true')
+parser.add_argument('--motion-blur', help='Blur radius of the motion mask (default: 15)', default=15, type=int)
+parser.add_argument('--motion-min-size',
+                    help='Ignore moving areas with fewer pixels in the motion mask (default: 100)', default=100,
+                    type=int)
+parser.add_argument('--min-sharpness',
+                    help='Skip the frames whose variance of the Laplacian is lower than this value, e.g. 100 (default: '
+                         '0, keep all frames)', default=0, type=float)
+parser.add_argument('--min-frame-difference',
+                    help='Skip the frames whose mean absolute difference with the last matched frame is lower than '
+                         'this number of grey levels, e.g. 2 (default: 0, keep all frames)', default=0, type=float)
+parser.add_argument('--min-keypoints',
+                    help='Skip the frames with fewer keypoints than this value (default: 0, keep all frames)',
+                    default=0, type=int)
+parser.add_argument('--pipeline',
+                    help='Capture frames in a thread of their own while other threads extract features and match them '
+                         '(frames of a camera are dropped when the workers fall behind)', action='store_true')
+parser.add_argument('-j', '--jobs',
+                    help='Number of feature extraction threads, and of matching threads, with --pipeline (default: '
+                         'number of CPUs)', default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--verbose', help='Time every processing stage and print a summary of them at the end',
+                    action='store_true')
+parser.add_argument('--profile', help='Write the stage timings and counters as JSON to this file (default: none)',
+                    default=None)
+parser.add_argument('--trace', help='Write every timed stage as a Chrome trace (chrome://tracing) to this file '
+                                    '(default: none)', default=None)
 parser.add_argument('--no-ui', help='Increase output verbosity', action='store_true')
 parser.add_argument('--buttons', help='Start capturing only on button click (RPi2 only)', action='store_true')
 args = vars(parser.parse_args())
 
 
-def get_detector(detector_type, options):
-    if detector_type == 'orb':
-        # Initialize the ORB descriptor, then detect keypoints and extract local invariant descriptors from the image.
-        detector = cv2.ORB_create(nfeatures=options['orb_n_features'])
-        norm = cv2.NORM_HAMMING
-    elif args['detector'] == 'akaze':
-        detector = cv2.AKAZE_create(descriptor_channels=options['akaze_n_channels'])
-        norm = cv2.NORM_HAMMING
-    else:
-        detector = cv2.xfeatures2d.SURF_create(hessianThreshold=options['surf_threshold'])
-        norm = cv2.NORM_L2
-
-    return detector, norm
-
-
-def get_matcher(matcher_type, norm):
-    if matcher_type == 'brute-force':
-        # Create Brute Force matcher.
-        matcher = cv2.BFMatcher(norm)
-    else:
-        if norm == cv2.NORM_HAMMING:
-            flann_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
-        else:
-            flann_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-
-        # Create FLANN matcher.
-        matcher = cv2.FlannBasedMatcher(flann_params, {})
-
-    return matcher
-
-
 def main():
     start = time.time()
 
@@ -89,19 +122,21 @@ def main():
         GPIO.setmode(GPIO.BCM)
         GPIO.setup(GPIO_NUMBER, GPIO.IN)
 
-    if verbose:
-        print('Args parsed: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+    if verbose or args["profile"] is not None or args["trace"] is not None:
+        instrumentation.enable(tracing=args["trace"] is not None)
 
     detector_options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
                             surf_threshold=args['surf_threshold'])
 
-    cap = cv2.VideoCapture(args['source'])
+    # A number is the index of a camera, anything else a video file or stream.
+    source = int(args['source']) if str(args['source']).isdigit() else args['source']
+    cap = cv2.VideoCapture(source)
     if cap is None or not cap.isOpened():
         print('Error: unable to open video source')
         return -1
 
-    detector, norm = get_detector(args['detector'], detector_options)
-    matcher = get_matcher(args['matcher'], norm)
+    detector = create_detector(args['detector'], detector_options)
+    norm = get_norm(args['detector'])
 
     statistics = []
 
@@ -118,8 +153,31 @@ def main():
 
     print("\033[94mTraining set has been prepared in %s seconds.\033[0m" % (time.time() - extraction_start))
 
+    catalog_index, vocabulary_index = load_or_build(image_descriptions, norm, args['data'], args['matcher'],
+                                                    args['catalog_index'], args['catalog_neighbours'],
+                                                    args['vocabulary_branching'], args['vocabulary_depth'])
+
+    catalog_matcher = CatalogMatcher(image_descriptions, norm, args['matcher'], catalog_index, args['prefilter_k'],
+                                     args['prefilter_min_correlation'], vocabulary_index, args['vocabulary_shortlist'])
+
     number_of_frames = args["n_frames"]
 
+    motion_mask = None
+    if args["motion_mask"]:
+        motion_mask = MotionMask(args['motion_blur'], args['motion_min_size'])
+
+    frame_gate = FrameGate(args['min_sharpness'], args['min_frame_difference'], args['min_keypoints'])
+
+    pipeline = None
+    if args["pipeline"]:
+        service = MatchService(image_descriptions, catalog_matcher, args['detector'], detector_options,
+                               ratio_test_coefficient)
+        # Frames of a video file are all matched, a camera does not wait for the workers.
+        pipeline = FramePipeline(cap, service.describe, service.match, args['jobs'],
+                                 drop_stale=isinstance(source, int),
+                                 segment=motion_mask.segment if motion_mask is not None else None,
+                                 gate=frame_gate)
+
     while True:
         while buttons:
             if GPIO.input(GPIO_NUMBER) == 1:
@@ -129,83 +187,91 @@ def main():
 
         matching_start = time.time()
 
-        while True:
-            ret, template = cap.read()
-
-            if not ret:
-                print("No frames is available.")
-                break
-
-            if len(statistics) > number_of_frames:
-                break
+        decision = None
+        if args["decision_margin"] is not None:
+            decision = SequentialDecision(len(image_descriptions), args["decision_margin"], args["decision_min_frames"])
 
-            gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        if pipeline is not None:
+            for frame_index, template, template_keypoints, match_result in pipeline.matched_frames(number_of_frames):
+                for image_index in range(len(image_descriptions)):
+                    statistics.append((template, template_keypoints, match_result, image_index,
+                                       match_result.scores[image_index]))
 
-            if verbose:
-                print('Template loaded: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+                if decision is not None:
+                    decision.add(match_result)
+                    if decision.is_decided():
+                        break
+        else:
+            frame_count = 0
+            while frame_count < number_of_frames:
+                ret, template = cap.read()
 
-            template_histogram = cv2.calcHist([template], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-            template_histogram = cv2.normalize(template_histogram, template_histogram).flatten()
+                if not ret:
+                    print("No frames is available.")
+                    break
 
-            if verbose:
-                print('Template histogram calculated: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+                instrumentation.count('frames captured')
 
-            (template_keypoints, template_descriptors) = detector.detectAndCompute(gray_template, None)
+                # Describe only the region of the frame around the moving object, if any.
+                template_mask = None
+                if motion_mask is not None:
+                    template, template_mask = motion_mask.segment(template)
 
-            if verbose:
-                print('Template keypoints have been detected: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+                if not frame_gate.accept_frame(template):
+                    continue
 
-            # loop over the images to find the template in
-            for image_description in image_descriptions:
-                matches = matcher.knnMatch(template_descriptors, trainDescriptors=image_description.descriptors, k=2)
+                with instrumentation.stage('describe.histogram'):
+                    template_histogram = compute_histogram(template, template_mask)
 
-                if verbose:
-                    print('{} image\'s match is processed: {:%H:%M:%S.%f}'.format(
-                        image_description.key, datetime.datetime.now()))
+                with instrumentation.stage('describe.detect'):
+                    gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+                    (template_keypoints, template_descriptors) = detector.detectAndCompute(gray_template,
+                                                                                           template_mask)
 
-                # Apply ratio test.
-                good_matches = []
-                for m in matches:
-                    if len(m) == 2 and m[0].distance < ratio_test_coefficient * m[1].distance:
-                        good_matches.append([m[0]])
+                if not frame_gate.accept_keypoints(template_keypoints):
+                    continue
 
-                if verbose:
-                    print('{} good matches filtered ({} good matches): {:%H:%M:%S.%f}'.format(image_description.key,
-                                                                                              len(good_matches),
-                                                                                              datetime.datetime.now()))
+                # Match the frame against all the images, then apply the ratio test and score them all at once.
+                match_result = catalog_matcher.match(template_descriptors, template_histogram, ratio_test_coefficient)
 
-                histogram_comparison_result = cv2.compareHist(template_histogram, image_description.histogram,
-                                                              cv2.HISTCMP_CORREL)
+                frame_count += 1
 
-                if verbose:
-                    print('{} image\'s histogram difference is calculated: {:%H:%M:%S.%f}'.format(image_description.key,
-                                                                                                  datetime.datetime.now()))
-                good_matches_count = len(good_matches)
-                matches_count = len(matches)
+                for image_index in range(len(image_descriptions)):
+                    statistics.append((template, template_keypoints, match_result, image_index,
+                                       match_result.scores[image_index]))
 
-                score = (0 if matches_count == 0 else good_matches_count / float(matches_count)) + \
-                        (0.01 * histogram_comparison_result)
+                if decision is not None:
+                    decision.add(match_result)
+                    if decision.is_decided():
+                        break
 
-                statistics.append((template, template_keypoints, image_description, matches, good_matches,
-                                   histogram_comparison_result, score))
+        if frame_gate.is_enabled():
+            print("\033[94mFrames %s.\033[0m" % frame_gate.describe_counters())
 
-        if verbose:
-            print('All images have been processed: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+        if decision is not None:
+            if decision.is_decided():
+                print("\033[92mDecided on %s after %d frames in %s seconds (margin: %s).\033[0m" % (
+                    image_descriptions[decision.leader()].key, decision.frame_count, time.time() - matching_start,
+                    decision.leader_margin()))
+            else:
+                print("\033[93mNo decision after %d frames in %s seconds (margin: %s).\033[0m" % (
+                    decision.frame_count, time.time() - matching_start, decision.leader_margin()))
 
-        # Sort by the largest number of "good" matches (3th element (zero based index = 2) of the tuple).
-        statistics = sorted(statistics, key=lambda arguments: arguments[6], reverse=True)
+        # Sort by score (5th element (zero based index = 4) of the tuple).
+        statistics = sorted(statistics, key=lambda arguments: arguments[4], reverse=True)
 
         print("\033[94mFull matching has been done in %s seconds.\033[0m" % (time.time() - matching_start))
 
         # Display results
         number_of_matches = args["n_matches"]
 
-        for idx, (template, template_keypoints, description, matches, good_matches, histogram_comparison_result, score) in \
-                enumerate(statistics[:10]):
+        for idx, (template, template_keypoints, match_result, image_index, score) in enumerate(statistics[:10]):
             # Mark in green only `n-matches` first matches.
             print("{}{}: {} - {} - {} - {}\033[0m".format('\033[92m' if idx < number_of_matches else '\033[91m',
-                                                          description.key, len(matches), len(good_matches),
-                                                          histogram_comparison_result, score))
+                                                          image_descriptions[image_index].key,
+                                                          match_result.matches_count,
+                                                          match_result.good_counts[image_index],
+                                                          match_result.histogram_correlations[image_index], score))
         if not buttons:
             break
         else:
@@ -213,6 +279,8 @@ def main():
 
     print("\033[94mProgram has been executed in %s seconds.\033[0m" % (time.time() - start))
 
+    instrumentation.report(verbose, args["profile"], args["trace"])
+
     cap.release()
 
     if not args["no_ui"]:
@@ -221,9 +289,10 @@ def main():
                   'files and created with the same options (--orb-n-features, --akaze-n-channels, --surf-threshold '
                   'etc.)!\033[0m'.format(args["data"]))
 
-        for idx, (template, template_keypoints, description, matches, good_matches, histogram_comparison_result, score) \
-                in enumerate(statistics[:number_of_matches]):
-            image = cv2.imread(description.key)
+        for idx, (template, template_keypoints, match_result, image_index, score) in \
+                enumerate(statistics[:number_of_matches]):
+            good_matches = match_result.good_matches(image_index)
+            image = cv2.imread(image_descriptions[image_index].key)
             gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             keypoints = detector.detect(gray_image)
 
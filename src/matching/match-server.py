@@ -0,0 +1,122 @@
+import argparse
+import multiprocessing
+import sys
+import time
+
+from classes.catalog_index import get_norm, load_or_build
+from classes.catalog_matcher import CatalogMatcher
+from classes.feature_extractor import FeatureExtractor
+from classes.match_cache import create_caches, matcher_options
+from classes.match_service import MatchServer, MatchService
+
+parser = argparse.ArgumentParser(
+    description='Loads the images to match once, then answers match queries sent to a local socket (see match.py '
+                '--server).')
+group = parser.add_mutually_exclusive_group(required=True)
+group.add_argument('-i', '--images', help='Path to the folder with the images we would like to match')
+group.add_argument('-d', '--data', help='Path to the feature database created by extract_features.py')
+parser.add_argument('-l', '--listen',
+                    help='Address to listen to: "host:port" for TCP, a path for a UNIX socket (default: '
+                         '/tmp/lighthouse-match.sock)', default='/tmp/lighthouse-match.sock')
+parser.add_argument('-j', '--jobs', help='Number of queries processed in parallel (default: number of CPUs)',
+                    default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--detector', help='Feature detector to use (default: orb)', choices=['orb', 'akaze', 'surf'],
+                    default='orb')
+parser.add_argument('--matcher',
+                    help='Matcher to use, "vocabulary" matches descriptors (by brute-force) only against the images '
+                         'that a visual vocabulary index ranks first (default: brute-force)',
+                    choices=['brute-force', 'flann', 'vocabulary'], default='brute-force')
+parser.add_argument('--vocabulary-shortlist',
+                    help='Number of images matched with --matcher=vocabulary (default: 10)', default=10, type=int)
+parser.add_argument('--vocabulary-branching',
+                    help='Number of children of every node of the vocabulary tree, the one stored next to the feature '
+                         'database by extract_features.py --build-vocabulary is rebuilt if it differs (default: 10)',
+                    default=10, type=int)
+parser.add_argument('--vocabulary-depth',
+                    help='Depth of the vocabulary tree, the one stored next to the feature database is rebuilt if it '
+                         'differs (default: 4)', default=4, type=int)
+parser.add_argument('--catalog-index',
+                    help='Search the descriptors of all images at once with a single index (with --matcher=flann, the '
+                         'index stored next to the feature database by extract_features.py --build-index is used)',
+                    action='store_true')
+parser.add_argument('--catalog-neighbours',
+                    help='Number of neighbours retrieved across the catalog with --catalog-index (default: 8)',
+                    default=8, type=int)
+parser.add_argument('--prefilter-k',
+                    help='Only match descriptors against the K images whose colour histogram is the closest to the '
+                         'template\'s (default: 0, match all images)', default=0, type=int)
+parser.add_argument('--prefilter-min-correlation',
+                    help='Only match descriptors against the images whose colour histogram correlation with the '
+                         'template is at least this value (default: none)', default=None, type=float)
+parser.add_argument('--ratio-test-k', help='Default ratio test coefficient (default: 0.75)', default=0.75, type=float)
+parser.add_argument('--orb-n-features', help='Number of features to extract used in ORB detector (default: 2000)',
+                    default=2000, type=int)
+parser.add_argument('--akaze-n-channels', help='Number of channels used in AKAZE detector (default: 3)',
+                    choices=[1, 2, 3], default=3, type=int)
+parser.add_argument('--surf-threshold',
+                    help='Threshold for hessian keypoint detector used in SURF detector (default: 1000)',
+                    default=1000, type=int)
+parser.add_argument('--cache-size',
+                    help='Number of query features and match results kept in memory, to answer the queries seen '
+                         'already without matching them again (default: 256, 0 disables the memory cache)',
+                    default=256, type=int)
+parser.add_argument('--cache-ttl', help='Seconds after which cached features and results expire (default: never)',
+                    default=None, type=float)
+parser.add_argument('--cache-dir',
+                    help='Also store the cached features and results in this folder, to reuse them after a restart '
+                         '(features are shared with match.py); results are discarded when the catalog changes '
+                         '(default: none)',
+                    default=None)
+parser.add_argument('--cache-disk-size', help='Number of files kept in every --cache-dir tier (default: 4096)',
+                    default=4096, type=int)
+parser.add_argument('--verbose', help='Increase output verbosity', action='store_true')
+args = vars(parser.parse_args())
+
+
+def main():
+    verbose = args["verbose"]
+
+    detector_options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
+                            surf_threshold=args['surf_threshold'])
+    norm = get_norm(args['detector'])
+
+    feature_extractor = FeatureExtractor(verbose, args['jobs'])
+
+    extraction_start = time.time()
+
+    if args["images"] is not None:
+        image_descriptions = feature_extractor.extract(args["images"], args['detector'], detector_options)
+    else:
+        image_descriptions = feature_extractor.deserialize(args["data"])
+
+    print("\033[94mTraining set has been prepared in %s seconds.\033[0m" % (time.time() - extraction_start))
+
+    catalog_index, vocabulary_index = load_or_build(image_descriptions, norm, args['data'], args['matcher'],
+                                                    args['catalog_index'], args['catalog_neighbours'],
+                                                    args['vocabulary_branching'], args['vocabulary_depth'])
+
+    catalog_matcher = CatalogMatcher(image_descriptions, norm, args['matcher'], catalog_index, args['prefilter_k'],
+                                     args['prefilter_min_correlation'], vocabulary_index, args['vocabulary_shortlist'])
+
+    feature_cache, result_cache = create_caches(args, 'query features')
+    service = MatchService(image_descriptions, catalog_matcher, args['detector'], detector_options,
+                           args['ratio_test_k'], feature_cache, result_cache, matcher_options(args))
+
+    server = MatchServer(args['listen'], service, args['jobs'])
+
+    print("\033[94mListening on %s.\033[0m" % args['listen'])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    for cache in (feature_cache, result_cache):
+        if cache is not None:
+            print("\033[94mCached %s.\033[0m" % cache.describe_counters())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,65 @@
 import argparse
 import cv2
-import datetime
+import multiprocessing
+import sys
 import time
 
-from classes.feature_extractor import FeatureExtractor
-
-FLANN_INDEX_KDTREE = 1
-FLANN_INDEX_LSH = 6
+from classes.batch_results import BatchResultWriter, list_templates
+from classes.catalog_index import get_norm, load_or_build
+from classes.catalog_matcher import CatalogMatcher
+from classes.feature_extractor import FeatureExtractor, compute_histogram, create_detector
+from classes.image_description import ImageDescription
+from classes.instrumentation import instrumentation
+from classes.match_cache import content_key, create_caches, matcher_options
+from classes.match_service import query_server
 
 start = time.time()
 
 parser = argparse.ArgumentParser(
     description='Finds the best match for the input image among the images in the provided folder.')
-parser.add_argument('-t', '--template', required=True, help='Path to the image we would like to find match for')
+template_group = parser.add_mutually_exclusive_group(required=True)
+template_group.add_argument('-t', '--template', help='Path to the image we would like to find match for')
+template_group.add_argument('-T', '--templates',
+                            help='Batch mode: folder, glob pattern or file listing the paths of the images we would '
+                                 'like to find matches for (requires --output)')
 
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument('-i', '--images', help='Path to the folder with the images we would like to match')
-group.add_argument('-d', '--data', help='Path to the folder with the images we would like to match')
+group.add_argument('-d', '--data', help='Path to the feature database created by extract_features.py')
+group.add_argument('-s', '--server',
+                   help='Address of a running match-server.py ("host:port" or the path of its UNIX socket) to send the '
+                        'template to, instead of matching it in this process')
 parser.add_argument('--detector', help='Feature detector to use (default: orb)', choices=['orb', 'akaze', 'surf'],
                     default='orb')
-parser.add_argument('--matcher', help='Matcher to use (default: brute-force)', choices=['brute-force', 'flann'],
-                    default='brute-force')
+parser.add_argument('--matcher',
+                    help='Matcher to use, "vocabulary" matches descriptors (by brute-force) only against the images '
+                         'that a visual vocabulary index ranks first (default: brute-force)',
+                    choices=['brute-force', 'flann', 'vocabulary'], default='brute-force')
+parser.add_argument('--vocabulary-shortlist',
+                    help='Number of images matched with --matcher=vocabulary (default: 10)', default=10, type=int)
+parser.add_argument('--vocabulary-branching',
+                    help='Number of children of every node of the vocabulary tree, the one stored next to the feature '
+                         'database by extract_features.py --build-vocabulary is rebuilt if it differs (default: 10)',
+                    default=10, type=int)
+parser.add_argument('--vocabulary-depth',
+                    help='Depth of the vocabulary tree, the one stored next to the feature database is rebuilt if it '
+                         'differs (default: 4)', default=4, type=int)
+parser.add_argument('--catalog-index',
+                    help='Search the descriptors of all images at once with a single index (with --matcher=flann, the '
+                         'index stored next to the feature database by extract_features.py --build-index is used)',
+                    action='store_true')
+parser.add_argument('--catalog-neighbours',
+                    help='Number of neighbours retrieved across the catalog with --catalog-index (default: 8)',
+                    default=8, type=int)
+parser.add_argument('--prefilter-k',
+                    help='Only match descriptors against the K images whose colour histogram is the closest to the '
+                         'template\'s (default: 0, match all images)', default=0, type=int)
+parser.add_argument('--prefilter-min-correlation',
+                    help='Only match descriptors against the images whose colour histogram correlation with the '
+                         'template is at least this value (default: none)', default=None, type=float)
+parser.add_argument('--prefilter-recall',
+                    help='Also match all images and report how many of the best matches the prefilter kept',
+                    action='store_true')
 parser.add_argument('--n-matches', help='Number of best matches to display  (default: 3)', default=3, type=int)
 parser.add_argument('--ratio-test-k', help='Ratio test coefficient (default: 0.75)', default=0.75, type=float)
 parser.add_argument('--orb-n-features', help='Number of features to extract used in ORB detector (default: 2000)',
@@ -30,140 +69,270 @@ parser.add_argument('--akaze-n-channels', help='Number of channels used in AKAZE
 parser.add_argument('--surf-threshold',
                     help='Threshold for hessian keypoint detector used in SURF detector (default: 1000)',
                     default=1000, type=int)
-parser.add_argument('--verbose', help='Increase output verbosity', action='store_true')
+parser.add_argument('-o', '--output', help='Batch mode: file to stream the best matches of every template to')
+parser.add_argument('--output-format', help='Batch mode: format of the output file (default: jsonl)',
+                    choices=['jsonl', 'csv'], default='jsonl')
+parser.add_argument('--batch-size', help='Batch mode: number of templates matched at once (default: 32)', default=32,
+                    type=int)
+parser.add_argument('-j', '--jobs', help='Batch mode: number of processes extracting template features (default: '
+                                         'number of CPUs)', default=multiprocessing.cpu_count(), type=int)
+parser.add_argument('--cache-size',
+                    help='Number of template features and match results kept in memory, to skip the templates seen '
+                         'already (default: 0, no memory cache)', default=0, type=int)
+parser.add_argument('--cache-ttl', help='Seconds after which cached features and results expire (default: never)',
+                    default=None, type=float)
+parser.add_argument('--cache-dir',
+                    help='Also store the cached features and results in this folder, to reuse them across runs '
+                         '(features are shared with match-server.py); results are discarded when the catalog changes '
+                         '(default: none)',
+                    default=None)
+parser.add_argument('--cache-disk-size', help='Number of files kept in every --cache-dir tier (default: 4096)',
+                    default=4096, type=int)
+parser.add_argument('--verbose', help='Time every processing stage and print a summary of them at the end',
+                    action='store_true')
+parser.add_argument('--profile', help='Write the stage timings and counters as JSON to this file (default: none)',
+                    default=None)
+parser.add_argument('--trace', help='Write every timed stage as a Chrome trace (chrome://tracing) to this file '
+                                    '(default: none)', default=None)
 parser.add_argument('--no-ui', help='Increase output verbosity', action='store_true')
 args = vars(parser.parse_args())
 
-verbose = args["verbose"]
-
-if verbose:
-    print('Args parsed: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
-
-template_start = time.time()
-
-# Load the image and convert it to grayscale.
-template = cv2.imread(args["template"])
-gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
-
-if verbose:
-    print('Template loaded: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
-
-template_histogram = cv2.calcHist([template], [0, 1, 2], None, [8, 8, 8], [0, 256, 0, 256, 0, 256])
-template_histogram = cv2.normalize(template_histogram, template_histogram).flatten()
 
-if verbose:
-    print('Template histogram calculated: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+def print_matches(matches):
+    for idx, match in enumerate(matches):
+        # Mark in green only `n-matches` first matches.
+        print("{}{}: {} - {} - {} - {}\033[0m".format('\033[92m' if idx < args["n_matches"] else '\033[91m',
+                                                      match['key'], match['matches'], match['good_matches'],
+                                                      match['histogram'], match['score']))
 
-detector_options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
-                        surf_threshold=args['surf_threshold'])
 
-if args['detector'] == 'orb':
-    # Initialize the ORB descriptor, then detect keypoints and extract local invariant descriptors from the image.
-    detector = cv2.ORB_create(nfeatures=detector_options['orb_n_features'])
-    norm = cv2.NORM_HAMMING
-elif args['detector'] == 'akaze':
-    detector = cv2.AKAZE_create(descriptor_channels=detector_options['akaze_n_channels'])
-    norm = cv2.NORM_HAMMING
-else:
-    detector = cv2.xfeatures2d.SURF_create(hessianThreshold=detector_options['surf_threshold'])
-    norm = cv2.NORM_L2
+def template_keys(template_path, n_matches, detector_options):
+    # Keys of the features of a template and of its `n_matches` best matches, computed from its content.
+    with open(template_path, 'rb') as template_file:
+        feature_key = content_key(template_file.read(), detector=args['detector'], **detector_options)
+    return feature_key, content_key(feature_key.encode('utf-8'), n_matches=n_matches, ratio_test_k=args['ratio_test_k'],
+                                    **matcher_options(args))
 
-if args['matcher'] == 'brute-force':
-    # Create Brute Force matcher.
-    matcher = cv2.BFMatcher(norm)
-else:
-    if norm == cv2.NORM_HAMMING:
-        flann_params = dict(algorithm=FLANN_INDEX_LSH, table_number=6,  key_size=12,  multi_probe_level=1)
-    else:
-        flann_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-
-    # Create FLANN matcher.
-    matcher = cv2.FlannBasedMatcher(flann_params, {})
-
-(template_keypoints, template_descriptors) = detector.detectAndCompute(gray_template, None)
 
-if verbose:
-    print('Template keypoints have been detected: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+def report_caches(caches):
+    for cache in caches:
+        if cache is not None:
+            print("\033[94mCached %s.\033[0m" % cache.describe_counters())
 
-print("\033[94mTemplate has been prepared in %s seconds.\033[0m" % (time.time() - template_start))
 
-statistics = []
+def main():
+    if args["templates"] is not None and (args["output"] is None or args["server"] is not None):
+        parser.error('--templates requires --output and cannot be used with --server')
 
-ratio_test_coefficient = args["ratio_test_k"]
+    verbose = args["verbose"]
 
-feature_extractor = FeatureExtractor(verbose)
+    if verbose or args["profile"] is not None or args["trace"] is not None:
+        instrumentation.enable(tracing=args["trace"] is not None)
 
-extraction_start = time.time()
+    if args["server"] is not None:
+        # Thin client: the server has the images loaded already, send it the encoded template and print its ranking.
+        with open(args["template"], 'rb') as template_file:
+            response = query_server(args["server"], dict(image=True, ratio_test_k=args["ratio_test_k"]),
+                                    template_file.read())
 
-if args["images"] is not None:
-    image_descriptions = feature_extractor.extract(args["images"], args['detector'], detector_options)
-else:
-    image_descriptions = feature_extractor.deserialize(args["data"])
+        print("\033[94mFull matching has been done in %s seconds (%s seconds on the server).\033[0m" % (
+            time.time() - start, response['time']))
 
-print("\033[94mTraining set has been prepared in %s seconds.\033[0m" % (time.time() - extraction_start))
+        print_matches(response['matches'])
+        return 0
 
-# loop over the images to find the template in
-for image_description in image_descriptions:
-    matches = matcher.knnMatch(template_descriptors, trainDescriptors=image_description.descriptors, k=2)
+    detector_options = dict(orb_n_features=args['orb_n_features'], akaze_n_channels=args['akaze_n_channels'],
+                            surf_threshold=args['surf_threshold'])
 
-    if verbose:
-        print('{} image\'s match is processed: {:%H:%M:%S.%f}'.format(image_description.key, datetime.datetime.now()))
+    detector = create_detector(args['detector'], detector_options)
+    norm = get_norm(args['detector'])
 
-    # Apply ratio test.
-    good_matches = []
-    for m in matches:
-        if len(m) == 2 and m[0].distance < ratio_test_coefficient * m[1].distance:
-            good_matches.append([m[0]])
+    feature_cache, result_cache = create_caches(args, 'template features')
 
-    if verbose:
-        print('{} good matches filtered ({} good matches): {:%H:%M:%S.%f}'.format(image_description.key,
-                                                                                  len(good_matches),
-                                                                                  datetime.datetime.now()))
+    # Displaying the matches needs the keypoints and the matches themselves, which are not cached.
+    use_cache = result_cache is not None and args["no_ui"] and not args["prefilter_recall"]
+    template_features = None
 
-    histogram_comparison_result = cv2.compareHist(template_histogram, image_description.histogram, cv2.HISTCMP_CORREL)
+    if args["template"] is not None and use_cache:
+        feature_key, result_key = template_keys(args["template"], None, detector_options)
 
-    if verbose:
-        print('{} image\'s histogram difference is calculated: {:%H:%M:%S.%f}'.format(image_description.key,
-                                                                                      datetime.datetime.now()))
+        matches = result_cache.get(result_key)
+        if matches is not None:
+            # The catalog does not even need to be loaded.
+            print("\033[94mFull matching has been done in %s seconds (cached results).\033[0m" % (time.time() - start))
+            print_matches(matches)
+            report_caches((feature_cache, result_cache))
+            instrumentation.report(verbose, args["profile"], args["trace"])
+            return 0
 
-    good_matches_count = len(good_matches)
-    matches_count = len(matches)
+        template_features = feature_cache.get(feature_key)
 
-    score = (0 if matches_count == 0 else good_matches_count / float(matches_count)) + \
-            (0.01 * histogram_comparison_result)
+    if template_features is not None:
+        template_descriptors, template_histogram = template_features
+    elif args["template"] is not None:
+        template_start = time.time()
 
-    statistics.append((image_description, matches, good_matches, histogram_comparison_result, score))
+        # Load the image and convert it to grayscale.
+        with instrumentation.stage('template.load'):
+            template = cv2.imread(args["template"])
+            gray_template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
 
-if verbose:
-    print('All images have been processed: {:%H:%M:%S.%f}'.format(datetime.datetime.now()))
+        with instrumentation.stage('template.histogram'):
+            template_histogram = compute_histogram(template)
 
-# Sort by the largest number of "good" matches (3th element (zero based index = 2) of the tuple).
-statistics = sorted(statistics, key=lambda arguments: arguments[4], reverse=True)
+        with instrumentation.stage('template.detect'):
+            (template_keypoints, template_descriptors) = detector.detectAndCompute(gray_template, None)
 
-print("\033[94mFull matching has been done in %s seconds.\033[0m" % (time.time() - start))
+        if use_cache:
+            feature_cache.put(feature_key, (template_descriptors, template_histogram))
 
-# Display results
+        print("\033[94mTemplate has been prepared in %s seconds.\033[0m" % (time.time() - template_start))
 
-number_of_matches = args["n_matches"]
+    ratio_test_coefficient = args["ratio_test_k"]
 
-for idx, (description, matches, good_matches, histogram_comparison_result, score) in enumerate(statistics):
-    # Mark in green only `n-matches` first matches.
-    print("{}{}: {} - {} - {} - {}\033[0m".format('\033[92m' if idx < number_of_matches else '\033[91m', description.key,
-                                             len(matches), len(good_matches), histogram_comparison_result, score))
+    feature_extractor = FeatureExtractor(verbose)
 
-if not args["no_ui"]:
-    if args["data"] is not None:
-        print('\033[93mWarning: Displaying of images side-by-side only works if "{}" is based on existing image files '
-              'and created with the same options '
-              '(--orb-n-features, --akaze-n-channels etc.)!\033[0m'.format(args["data"]))
+    extraction_start = time.time()
 
-    for idx, (description, matches, good_matches, histogram_comparison_result, score) in enumerate(
-            statistics[:number_of_matches]):
-        image = cv2.imread(description.key)
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        keypoints = detector.detect(gray_image)
-
-        result_image = cv2.drawMatchesKnn(template, template_keypoints, image, keypoints, good_matches, None, flags=2)
-        cv2.imshow("Best match #" + str(idx + 1), result_image)
-
-    cv2.waitKey(0)
+    if args["images"] is not None:
+        image_descriptions = feature_extractor.extract(args["images"], args['detector'], detector_options)
+    else:
+        image_descriptions = feature_extractor.deserialize(args["data"])
+
+    print("\033[94mTraining set has been prepared in %s seconds.\033[0m" % (time.time() - extraction_start))
+
+    catalog_index, vocabulary_index = load_or_build(image_descriptions, norm, args['data'], args['matcher'],
+                                                    args['catalog_index'], args['catalog_neighbours'],
+                                                    args['vocabulary_branching'], args['vocabulary_depth'])
+
+    catalog_matcher = CatalogMatcher(image_descriptions, norm, args['matcher'], catalog_index, args['prefilter_k'],
+                                     args['prefilter_min_correlation'], vocabulary_index, args['vocabulary_shortlist'])
+
+    if args["templates"] is not None:
+        template_paths = list_templates(args["templates"])
+        batch_size = max(1, args["batch_size"])
+        template_extractor = FeatureExtractor(verbose, args["jobs"])
+
+        with BatchResultWriter(args["output"], args["output_format"]) as result_writer:
+            for batch_start in range(0, len(template_paths), batch_size):
+                batch_paths = template_paths[batch_start:batch_start + batch_size]
+                batch_matches = [None] * len(batch_paths)
+                templates = [None] * len(batch_paths)
+                # Templates that cannot be read get an error row, the rest of the batch goes on.
+                batch_errors = [None] * len(batch_paths)
+
+                if result_cache is not None:
+                    batch_keys = [None] * len(batch_paths)
+                    for position, template_path in enumerate(batch_paths):
+                        try:
+                            batch_keys[position] = template_keys(template_path, args["n_matches"], detector_options)
+                        except (IOError, OSError):
+                            batch_errors[position] = 'Unable to read image'
+                            continue
+
+                        feature_key, result_key = batch_keys[position]
+                        batch_matches[position] = result_cache.get(result_key)
+                        template_features = None if batch_matches[position] is not None else \
+                            feature_cache.get(feature_key)
+                        if template_features is not None:
+                            templates[position] = ImageDescription(batch_paths[position], *template_features)
+
+                # Only the templates whose features and results are not cached are described, then matched.
+                missing = [position for position in range(len(batch_paths)) if batch_errors[position] is None and
+                           batch_matches[position] is None and templates[position] is None]
+                if missing:
+                    described = template_extractor.extract_images([batch_paths[position] for position in missing],
+                                                                  args['detector'], detector_options, True)
+                    for position, template_description in zip(missing, described):
+                        if template_description is None:
+                            batch_errors[position] = 'Unable to read image'
+                            continue
+
+                        templates[position] = template_description
+                        if feature_cache is not None:
+                            feature_cache.put(batch_keys[position][0], (template_description.descriptors,
+                                                                        template_description.histogram))
+
+                unmatched = [position for position in range(len(batch_paths))
+                             if batch_errors[position] is None and batch_matches[position] is None]
+                match_results = catalog_matcher.match_batch([(templates[position].descriptors,
+                                                              templates[position].histogram)
+                                                             for position in unmatched],
+                                                            ratio_test_coefficient) if unmatched else []
+
+                for position, match_result in zip(unmatched, match_results):
+                    batch_matches[position] = match_result.top(image_descriptions, args["n_matches"])
+                    if result_cache is not None:
+                        result_cache.put(batch_keys[position][1], batch_matches[position])
+
+                for template_path, matches, error in zip(batch_paths, batch_matches, batch_errors):
+                    if error is not None:
+                        print('\033[93mWarning: unable to read template "{}", skipping it.\033[0m'.format(
+                            template_path))
+                        result_writer.write_error(template_path, error)
+                    else:
+                        result_writer.write(template_path, matches)
+
+        print("\033[94m%d templates have been matched in %s seconds.\033[0m" % (len(template_paths),
+                                                                                time.time() - start))
+        report_caches((feature_cache, result_cache))
+        instrumentation.report(verbose, args["profile"], args["trace"])
+        return 0
+
+    # Match the template against all the images, then apply the ratio test and score them all at once.
+    match_result = catalog_matcher.match(template_descriptors, template_histogram, ratio_test_coefficient)
+
+    # Sort by score (the proportion of "good" matches, plus a bit of the histogram correlation).
+    ranking = match_result.ranking()
+
+    print("\033[94mFull matching has been done in %s seconds.\033[0m" % (time.time() - start))
+
+    if catalog_matcher.is_prefiltering():
+        print("\033[94mDescriptors have been matched against %d/%d images.\033[0m" % (match_result.candidates.sum(),
+                                                                                      len(image_descriptions)))
+
+        if args["prefilter_recall"]:
+            full_scan_start = time.time()
+            full_scan_result = catalog_matcher.match(template_descriptors, template_histogram, ratio_test_coefficient,
+                                                     prefilter=False)
+
+            print("\033[94mFull scan has been done in %s seconds, prefilter recall of the %d best matches: %s.\033[0m" %
+                  (time.time() - full_scan_start, args["n_matches"], match_result.recall(full_scan_result,
+                                                                                        args["n_matches"])))
+
+    # Display results
+
+    number_of_matches = args["n_matches"]
+
+    matches = match_result.top(image_descriptions)
+    print_matches(matches)
+
+    if use_cache:
+        result_cache.put(result_key, matches)
+        report_caches((feature_cache, result_cache))
+
+    instrumentation.report(verbose, args["profile"], args["trace"])
+
+    if not args["no_ui"]:
+        if args["data"] is not None:
+            print('\033[93mWarning: Displaying of images side-by-side only works if "{}" is based on existing image '
+                  'files and created with the same options '
+                  '(--orb-n-features, --akaze-n-channels etc.)!\033[0m'.format(args["data"]))
+
+        for idx, image_index in enumerate(ranking[:number_of_matches]):
+            good_matches = match_result.good_matches(image_index)
+            image = cv2.imread(image_descriptions[image_index].key)
+            gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            keypoints = detector.detect(gray_image)
+
+            result_image = cv2.drawMatchesKnn(template, template_keypoints, image, keypoints, good_matches, None,
+                                              flags=2)
+            cv2.imshow("Best match #" + str(idx + 1), result_image)
+
+        cv2.waitKey(0)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
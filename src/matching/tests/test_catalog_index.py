@@ -0,0 +1,36 @@
+import unittest
+
+import cv2
+import numpy
+
+from classes.catalog_index import CatalogIndex
+from classes.catalog_matcher import CatalogMatcher
+from classes.image_description import HISTOGRAM_SIZE, ImageDescription
+
+
+class CatalogIndexTest(unittest.TestCase):
+    """The images found among the neighbours of a descriptor get the distances of images matched on their own."""
+
+    def test_nearest_per_image(self):
+        random = numpy.random.RandomState(0)
+        image_descriptions = [ImageDescription('image-%d' % index,
+                                               random.randint(0, 256, (50, 32)).astype(numpy.uint8),
+                                               numpy.ones(HISTOGRAM_SIZE, dtype=numpy.float32))
+                              for index in range(6)]
+        query_descriptors = random.randint(0, 256, (40, 32)).astype(numpy.uint8)
+
+        catalog_index = CatalogIndex(image_descriptions, cv2.NORM_HAMMING, 'brute-force', neighbours=4)
+        first_distances, second_distances, first_indices = catalog_index.nearest_per_image(query_descriptors)
+        catalog_matcher = CatalogMatcher(image_descriptions, cv2.NORM_HAMMING, 'brute-force')
+        expected_first_distances, expected_second_distances, _ = catalog_matcher.nearest_per_image(query_descriptors)
+
+        found = first_indices >= 0
+        # With 4 neighbours among 6 images, some images are seen once only and some not at all.
+        self.assertTrue(found.any() and not found.all())
+        numpy.testing.assert_array_equal(first_distances[found], expected_first_distances[found])
+        numpy.testing.assert_array_equal(second_distances[found], expected_second_distances[found])
+        self.assertTrue(numpy.isinf(second_distances[~found]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy
+
+from classes.catalog_matcher import CatalogMatcher
+from classes.feature_database import FeatureDatabase
+from classes.feature_extractor import FeatureExtractor
+from classes.image_description import HISTOGRAM_SIZE
+
+
+class EmptyCatalogTest(unittest.TestCase):
+    """A folder without images gives an empty feature database, and matching against it finds nothing."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_write_and_open(self):
+        database_path = os.path.join(self.directory, 'features.db')
+        FeatureDatabase.write([], database_path)
+
+        database = FeatureDatabase.open(database_path)
+        self.assertEqual(len(database), 0)
+        self.assertEqual(database.histograms.shape, (0, HISTOGRAM_SIZE))
+        self.assertEqual(database.image_descriptions(), [])
+
+    def test_incremental_after_removing_every_image(self):
+        image_path = os.path.join(self.directory, 'image.jpg')
+        cv2.imwrite(image_path, numpy.random.RandomState(0).randint(0, 256, (64, 64, 3)).astype(numpy.uint8))
+        database_path = os.path.join(self.directory, 'features.db')
+        feature_extractor = FeatureExtractor(False, 1)
+        options = dict(orb_n_features=500, akaze_n_channels=3, surf_threshold=1000)
+
+        # Written with the metadata of extract_features.py, for the second run to reuse the first one.
+        for _ in range(2):
+            image_descriptions, fingerprints = feature_extractor.extract_incremental(self.directory, 'orb', options,
+                                                                                     database_path)
+            FeatureDatabase.write(image_descriptions, database_path,
+                                  dict(detector='orb', options=options, pruning=None, fingerprints=fingerprints))
+            if os.path.exists(image_path):
+                self.assertEqual(len(FeatureDatabase.open(database_path)), 1)
+                os.remove(image_path)
+
+        self.assertEqual(len(FeatureDatabase.open(database_path)), 0)
+
+    def test_match(self):
+        catalog_matcher = CatalogMatcher([], cv2.NORM_HAMMING, 'brute-force')
+        template = (numpy.zeros((10, 32), dtype=numpy.uint8), numpy.ones(HISTOGRAM_SIZE, dtype=numpy.float32))
+
+        self.assertEqual(catalog_matcher.match(template[0], template[1], 0.75).top([]), [])
+        self.assertEqual([match_result.top([]) for match_result in catalog_matcher.match_batch([template], 0.75)],
+                         [[]])
+
+
+if __name__ == '__main__':
+    unittest.main()